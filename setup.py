@@ -32,5 +32,8 @@ setup(
         "python-statemachine==2.1.2",
         "redis==5.0.1",
         "influxdb-client==1.39.0",
-    ]
+    ],
+    extras_require={
+        "codecs": ["orjson", "msgpack"],
+    }
 )
@@ -0,0 +1,111 @@
+import json
+import os
+
+# Optional faster/binary serialisers, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Codec used by producers unless one is given: json, orjson or msgpack
+PYGS_CODEC = os.getenv('PYGS_CODEC', 'json')
+
+
+class JsonCodec():
+    """
+    The standard library json module. Always available.
+    """
+    name = 'json'
+    content_type = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec():
+    """
+    orjson, producing the same JSON as JsonCodec several times faster,
+    except that NaN and Infinity are written as null. orjson rejects the
+    NaN and Infinity tokens json.dumps writes, so such documents are
+    read with json.loads instead.
+    """
+    name = 'orjson'
+    content_type = 'json'
+
+    def encode(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def decode(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+
+class MsgpackCodec():
+    """
+    MessagePack, a compact binary encoding
+    """
+    name = 'msgpack'
+    content_type = 'msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+CODECS = {'json': JsonCodec()}
+if orjson is not None:
+    CODECS['orjson'] = OrjsonCodec()
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+# Decoder for each content type. JSON is read with orjson when available,
+# whichever codec wrote it.
+_DECODERS = {
+    'json': CODECS.get('orjson', CODECS['json']),
+    'application/json': CODECS.get('orjson', CODECS['json']),
+}
+if msgpack is not None:
+    _DECODERS['msgpack'] = CODECS['msgpack']
+    _DECODERS['application/msgpack'] = CODECS['msgpack']
+
+# First bytes of a JSON document, including the NaN and Infinity tokens
+# json.dumps writes
+_JSON_START = frozenset(b'{["-0123456789tfnNI \t\r\n')
+
+
+def get_codec(name=None):
+    """
+    Return the codec called name, or the PYGS_CODEC default. A codec
+    whose module is not installed falls back to json.
+    """
+    return CODECS.get(name or PYGS_CODEC, CODECS['json'])
+
+
+def decode(data, content_type=None):
+    """
+    Decode a message body written by any codec. Without a content type
+    (e.g. a Redis value) the format is detected from the first byte:
+    JSON text starts with one of {["- or a digit, anything else is taken
+    as msgpack. Data in neither format, such as a plain string published
+    by another client, raises ValueError.
+    """
+    decoder = _DECODERS.get(content_type)
+    if decoder is None:
+        decoder = _DECODERS['json']
+        if msgpack is not None and data:
+            first = ord(data[0]) if isinstance(data, str) else data[0]
+            if first not in _JSON_START:
+                decoder = CODECS['msgpack']
+    return decoder.decode(data)
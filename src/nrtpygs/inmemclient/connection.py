@@ -1,5 +1,6 @@
 import nrtpygs.customlogger as log
 import os
+import threading
 import time
 import redis
 
@@ -10,60 +11,125 @@ REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
 # This parameter determines if the redis instance we connect to is a cluster or not. 
 REDIS_CLUSTER = os.getenv('REDIS_CLUSTER', 'False').lower() in ('true', '1', 't')
 
-# POOL = redis.ConnectionPool(
-#     host=REDIS_HOST,
-#     username=REDIS_USERNAME,
-#     password=REDIS_PASSWORD,
-#     port=6379)
+# Limits of the connection pool shared by every Connection to a server,
+# and seconds between health checks of an idle pooled connection (a PING
+# sent before the connection is next used)
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL',
+                                            '30'))
+
+# Seconds connect() keeps retrying an unreachable server, backing off
+# exponentially up to REDIS_RETRY_MAX seconds between attempts
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', '30'))
+REDIS_RETRY_MAX = 5.0
+
+# Shared clients by (host, username, password, cluster), with the number
+# of Connections using each
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host, username=None, password=None, cluster=False):
+    """
+    Return the process-wide client for a server, creating it on first
+    use. Clients are thread safe and hand out connections from one pool
+    of up to REDIS_MAX_CONNECTIONS keepalive connections, so Producers,
+    Consumers and Readers in a process share them. Call release_client()
+    with the same arguments when done.
+    """
+    key = (host, username, password, cluster)
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            options = dict(
+                username=username,
+                password=password,
+                port=6379,
+                socket_keepalive=True,
+                health_check_interval=REDIS_HEALTH_CHECK_INTERVAL)
+            if cluster:
+                client = redis.RedisCluster(
+                    host=host, max_connections=REDIS_MAX_CONNECTIONS,
+                    **options)
+            else:
+                client = redis.Redis(
+                    connection_pool=redis.BlockingConnectionPool(
+                        host=host, max_connections=REDIS_MAX_CONNECTIONS,
+                        **options))
+            entry = _clients[key] = [client, 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def release_client(host, username=None, password=None, cluster=False):
+    """
+    Stop using a client from get_client(), closing it when no one else is
+    """
+    key = (host, username, password, cluster)
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _clients[key]
+    client = entry[0]
+    client.close()
+    if not cluster:
+        # A client given its own pool leaves the pool open on close()
+        client.connection_pool.disconnect()
 
 
 class Connection():
     """
     Class to provide connection and new channel options to the redis server
-    At present a single channel is opened and the object returned.
+    The connection is the process-wide shared client for the server (see
+    get_client()), which checks the health of its pooled connections
+    itself, so get_connection() costs no round trip.
     """
 
     def __init__(self):
-        # self._pool = POOL
+        self.connection = None
         self._logger = log.get_logger()
 
-    def connect(self):
+    def connect(self, timeout=REDIS_CONNECT_TIMEOUT):
         """
-        Create a connection, start the ioloop to connect
-        inside a thread and then return the connection
+        Get the shared client and wait for the server to answer a PING,
+        retrying with exponential backoff for up to timeout seconds
         """
         self._logger.debug('Attempting to connect to Redis')
-        if REDIS_CLUSTER:
-            self.connection = redis.RedisCluster(
-                host=os.environ['REDIS_HOST'],
-                username=REDIS_USERNAME,
-                password=REDIS_PASSWORD,
-                port=6379)
-
-        else:
-            self.connection = redis.Redis(
-                host=os.environ['REDIS_HOST'],
-                username=REDIS_USERNAME,
-                password=REDIS_PASSWORD,
-                port=6379)
+        self._key = (os.environ['REDIS_HOST'], REDIS_USERNAME,
+                     REDIS_PASSWORD, REDIS_CLUSTER)
+        self.connection = get_client(*self._key)
 
         self._logger.debug('Connecting to %s', REDIS_HOST)
         # Wait to allow connection to open before returning
-        while not self.connection.ping():
-            pass
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            try:
+                self.connection.ping()
+                break
+            except redis.exceptions.ConnectionError as e:
+                if time.monotonic() + delay > deadline:
+                    self.close()
+                    raise
+                self._logger.warning(
+                    'Redis not reachable (%s), retrying in %.1fs', e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, REDIS_RETRY_MAX)
         self._logger.debug('Connection opened')
         return self.connection
 
     def get_connection(self):
-        while not self.connection.ping():
-            time.sleep(0.1)
-            pass
         return self.connection
 
     def close(self):
         self._logger.debug('Closing Connection')
         if self.connection is not None:
-            self.connection.close()
+            self.connection = None
+            release_client(*self._key)
 
 
 def main():
@@ -1,6 +1,16 @@
 from nrtpygs.inmemclient.connection import Connection
+from nrtpygs.mqclient.mqdispatch import KeyedDispatcher
+from nrtpygs.codec import decode
 import nrtpygs.customlogger as log
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
+import os
+import threading
+import time
+
+# Most messages a Consumer with workers holds queued or running before its
+# listener stops reading from Redis
+REDIS_CONSUMER_BACKLOG = int(os.getenv('REDIS_CONSUMER_BACKLOG', '1000'))
 
 
 class Consumer():
@@ -20,31 +30,129 @@ class Consumer():
         - binding keys
         - queue_name
         - callback
+
+    With decode=True the message data is decoded (see nrtpygs.codec)
+    before the callback is called, giving the Producer envelope as a dict.
+    Data that is neither JSON nor msgpack, e.g. a plain string published
+    by another client, is logged and passed to the callback undecoded.
+
+    All subscriptions share one pubsub connection and one listener thread,
+    which blocks waiting for messages rather than polling and calls the
+    callback of the pattern each message matched. With workers > 0
+    callbacks run on a pool of that many threads instead of the listener,
+    with the messages of each channel still handled in order. At most
+    backlog messages are queued or running at once; beyond that the
+    listener waits for a callback to finish before reading on, leaving
+    further messages to Redis.
     """
 
-    def __init__(self):
+    def __init__(self, workers=0, backlog=REDIS_CONSUMER_BACKLOG):
         self._connection = Connection()
         self._connection.connect()
+        self._pubsub = self._connection.connection.pubsub()
+        # pattern -> callback
+        self._callbacks = {}
         self._consumers = []
+        self._listener = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        if workers:
+            self._dispatcher = KeyedDispatcher(ThreadPoolExecutor(workers))
+            self._in_flight = threading.BoundedSemaphore(backlog)
         self._logger = log.get_logger()
 
-    def subscribe(self, key: str, callback):
+    def subscribe(self, key: str, callback, decode=False):
+        if decode:
+            callback = self._decoding(callback)
         try:
-            pubsub = self._connection.connection.pubsub()
-            pubsub.psubscribe(**{key: callback})
-            thread = pubsub.run_in_thread(sleep_time=0.001)
-            self._consumers.append(thread)
+            with self._lock:
+                self._callbacks[key] = callback
+                self._pubsub.psubscribe(key)
+                if self._listener is None:
+                    self._listener = threading.Thread(
+                        target=self._listen,
+                        args=(),
+                        daemon=True)
+                    self._listener.start()
+                    self._consumers.append(self._listener)
             self._logger.info('Consuming %s on redis server' % key)
         except Exception as e:
             self._logger.error(
                 'Unable to subscribe to channel %s: %s' % (key, e))
 
+    def _listen(self):
+        """
+        Hand each message to its pattern's callback until disconnected
+        """
+        while not self._stopping:
+            try:
+                for message in self._pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self._dispatch(message)
+            except Exception as e:
+                if self._stopping:
+                    break
+                self._logger.error('Redis subscription failed: %s' % e)
+                time.sleep(1)
+                continue
+            with self._lock:
+                if not self._pubsub.subscribed:
+                    self._listener = None
+                    return
+
+    def _dispatch(self, message: dict):
+        pattern = message['pattern']
+        if isinstance(pattern, bytes):
+            pattern = pattern.decode()
+        callback = self._callbacks.get(pattern)
+        if callback is None:
+            return
+        if self._dispatcher is not None:
+            # Released by _on_done once the callback has run
+            self._in_flight.acquire()
+            try:
+                self._dispatcher.submit(
+                    message['channel'], callback, (message,), self._on_done)
+            except Exception:
+                self._in_flight.release()
+                raise
+            return
+        try:
+            callback(message)
+        except Exception as e:
+            self._logger.error(
+                'Callback failed on %s: %s' % (message['channel'], e))
+
+    def _on_done(self, future):
+        self._in_flight.release()
+        if future.exception() is not None:
+            self._logger.error('Callback failed: %s' % future.exception())
+
+    def _decoding(self, callback):
+        """
+        Wrap callback to decode the message data first
+        """
+        def on_message(message: dict):
+            try:
+                message['data'] = decode(message['data'])
+            except ValueError as e:
+                self._logger.warning(
+                    'Passing undecoded message on %s: %s'
+                    % (message['channel'], e))
+            callback(message)
+        return on_message
+
     def get_consumers(self):
         return self._consumers
 
     def disconnect(self):
+        self._stopping = True
+        self._pubsub.close()
         for thread in self._consumers:
-            thread.stop()
+            thread.join()
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown()
         self._connection.close()
 
 
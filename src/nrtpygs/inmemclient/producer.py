@@ -1,43 +1,207 @@
 import datetime
-from nrtpygs.inmemclient.connection import Connection
+from nrtpygs.inmemclient.connection import Connection, REDIS_CLUSTER
+from nrtpygs.codec import get_codec
 import nrtpygs.customlogger as log
-import json
+from collections import OrderedDict
+import os
+import threading
+import time
+
+# Auto-batching producers send their buffer every this many seconds, or
+# once this many keys are waiting, and hold at most buffer_size keys
+REDIS_FLUSH_INTERVAL = float(os.getenv('REDIS_FLUSH_INTERVAL', '0.01'))
+REDIS_FLUSH_COUNT = int(os.getenv('REDIS_FLUSH_COUNT', '1000'))
+REDIS_BUFFER_SIZE = int(os.getenv('REDIS_BUFFER_SIZE', '100000'))
 
 
 class Producer():
+    """
+    Publish values to Redis keys. Each value is wrapped in an envelope
+    with a timestamp and the source, serialised with codec (see
+    nrtpygs.codec, default json). The codec is not recorded in the
+    message; readers detect the format from the first byte, so producers
+    using different codecs can share keys.
 
-    def __init__(self, source='Unknown'):
+    The envelope is serialised once and sent with PUBLISH and SET in a
+    single pipeline, so one round trip per publish(), or per
+    publish_many() however many keys it writes. With transactional=True
+    the pipeline runs as a MULTI/EXEC transaction, so readers never see
+    the SET without the PUBLISH. Redis Cluster supports neither
+    transactions nor PUBLISH in a pipeline, so there only the SETs are
+    pipelined and each PUBLISH is sent after them on its own.
+
+    With batch=True publish() only buffers the value and returns, and a
+    background thread sends the buffer in one pipeline every
+    flush_interval seconds or once flush_count keys are waiting. Only the
+    latest value of each key in the buffer is sent. publish() blocks while
+    buffer_size keys are waiting, and flush() sends the buffer straight
+    away; disconnect() flushes before closing.
+    """
+
+    def __init__(self, source='Unknown', codec=None, transactional=False,
+                 batch=False, flush_interval=REDIS_FLUSH_INTERVAL,
+                 flush_count=REDIS_FLUSH_COUNT,
+                 buffer_size=REDIS_BUFFER_SIZE):
         self.source = source
+        self._codec = get_codec(codec)
         self._cluster = Connection()
         self._connection = self._cluster.connect()
         self._logger = log.get_logger()
+        if transactional and REDIS_CLUSTER:
+            self._logger.warning(
+                'Redis Cluster does not support transactions, '
+                'publishing without')
+            transactional = False
+        self._transactional = transactional
+        self._stopping = False
+        self._batch = batch
+        if batch:
+            self._flush_interval = flush_interval
+            self._flush_count = max(1, flush_count)
+            self._buffer_size = max(1, buffer_size)
+            # key -> (value, timestamp) waiting to be sent, guarded by
+            # _buffer_cond. _send_lock keeps buffers going out in order.
+            self._buffer = OrderedDict()
+            self._buffer_start = None
+            self._buffer_cond = threading.Condition()
+            self._send_lock = threading.Lock()
+            self._flushThread = threading.Thread(
+                target=self._flush_loop,
+                args=())
+            self._flushThread.start()
 
     def publish(self, key, value):
         """
-        Add message to python queue
+        Publish value on key and set key to it
         """
-        time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
-        body = {
-            'timestamp': time,
-            'source': self.source,
-            'content': value,
-        }
+        if self._batch:
+            self._buffer_value(key, value)
+            return
         self._logger.debug('Setting key %s' % key)
         try:
-            self._logger.debug('Publishing')
-            self._connection.publish(key, json.dumps(body))
-            self._logger.debug('Setting')
-            self._connection.set(key, json.dumps(body))
+            self._send({key: value})
         except Exception as e:
             self._logger.error('Unable to publish message for key %s: %s' % (key, e))
 
+    def publish_many(self, mapping):
+        """
+        Publish and set each key to its value in mapping, all in one
+        pipeline
+        """
+        if self._batch:
+            for key, value in mapping.items():
+                self._buffer_value(key, value)
+            return
+        self._logger.debug('Setting %d keys' % len(mapping))
+        try:
+            self._send(mapping)
+        except Exception as e:
+            self._logger.error('Unable to publish messages for %d keys: %s'
+                               % (len(mapping), e))
+
+    def flush(self):
+        """
+        Send the buffered values now, in batch mode
+        """
+        if not self._batch:
+            return
+        with self._send_lock:
+            with self._buffer_cond:
+                buffer = self._buffer
+                self._buffer = OrderedDict()
+                self._buffer_start = None
+                self._buffer_cond.notify_all()
+            if not buffer:
+                return
+            self._logger.debug('Flushing %d keys' % len(buffer))
+            try:
+                self._send_entries(
+                    (key, value, stamp)
+                    for key, (value, stamp) in buffer.items())
+            except Exception as e:
+                self._logger.error('Unable to flush messages for %d keys: %s'
+                                   % (len(buffer), e))
+
+    def _buffer_value(self, key, value):
+        stamp = datetime.datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        with self._buffer_cond:
+            while len(self._buffer) >= self._buffer_size and \
+                    key not in self._buffer:
+                self._buffer_cond.wait()
+            if not self._buffer:
+                self._buffer_start = time.monotonic()
+                self._buffer_cond.notify_all()
+            self._buffer[key] = (value, stamp)
+            if len(self._buffer) >= self._flush_count:
+                self._buffer_cond.notify_all()
+
+    def _flush_loop(self):
+        """
+        Flush the buffer flush_interval after its first value arrives, or
+        sooner if flush_count keys are waiting
+        """
+        while True:
+            with self._buffer_cond:
+                while not self._buffer and not self._stopping:
+                    self._buffer_cond.wait()
+                if not self._buffer:
+                    return
+                while len(self._buffer) < self._flush_count and \
+                        not self._stopping and self._buffer_start is not None:
+                    remaining = self._buffer_start + self._flush_interval \
+                        - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._buffer_cond.wait(remaining)
+            self.flush()
+
+    def _send(self, mapping):
+        stamp = datetime.datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%S.%f')[:-3]
+        self._send_entries(
+            (key, value, stamp) for key, value in mapping.items())
+
+    def _send_entries(self, entries):
+        """
+        PUBLISH and SET (key, value, timestamp) entries in one pipeline
+        """
+        pipe = self._connection.pipeline(transaction=self._transactional)
+        if REDIS_CLUSTER:
+            payloads = []
+            for key, value, stamp in entries:
+                payload = self._codec.encode(self._envelope(value, stamp))
+                payloads.append((key, payload))
+                pipe.set(key, payload)
+            pipe.execute()
+            for key, payload in payloads:
+                self._connection.publish(key, payload)
+            return
+        for key, value, stamp in entries:
+            payload = self._codec.encode(self._envelope(value, stamp))
+            pipe.publish(key, payload)
+            pipe.set(key, payload)
+        pipe.execute()
+
+    def _envelope(self, value, stamp):
+        return {
+            'timestamp': stamp,
+            'source': self.source,
+            'content': value,
+        }
+
     def disconnect(self):
         self._logger.info('Disconnecting Production Connection')
         self._stopping = True
         # Wait for all messages to be sent
+        if self._batch:
+            with self._buffer_cond:
+                self._buffer_cond.notify_all()
+            self._flushThread.join()
+            self.flush()
 
-        # Close the connection and rejoin the log thread
-        self._connection.close()
+        # Release the shared connection
+        self._cluster.close()
 
 
 def main():
@@ -0,0 +1,194 @@
+from nrtpygs.inmemclient.connection import Connection
+from nrtpygs.codec import decode
+import nrtpygs.customlogger as log
+from collections import OrderedDict
+import itertools
+import os
+import threading
+import time
+
+# Keys a Reader caches, and seconds a cached value is trusted for (0 is
+# until the key is published again)
+REDIS_READ_CACHE_SIZE = int(os.getenv('REDIS_READ_CACHE_SIZE', '10000'))
+REDIS_READ_CACHE_TTL = float(os.getenv('REDIS_READ_CACHE_TTL', '0'))
+
+
+class Reader():
+    """
+    Read Redis keys written by Producer through a local LRU cache of up
+    to cache_size keys.
+
+    Producer publishes every value it sets on a channel named after the
+    key, so the Reader subscribes to each key it caches and updates the
+    cached value from those messages: repeated reads of a hot key are
+    memory lookups, yet never older than the last publish. A key is only
+    cached once its subscription is confirmed. Subscribed keys, cached
+    or not, are held in an LRU of cache_size keys, and a key is
+    unsubscribed when it is evicted from it or invalidated. Values
+    written to Redis some other way are not seen, nor are those published
+    while the subscription connection is down, so a ttl (in seconds)
+    bounds how long a cached value is trusted.
+
+    With decode=True get() returns the decoded Producer envelope (see
+    nrtpygs.codec) rather than the raw bytes. hits and misses count the
+    reads served from the cache and from Redis.
+    """
+
+    def __init__(self, cache_size=REDIS_READ_CACHE_SIZE,
+                 ttl=REDIS_READ_CACHE_TTL, decode=False):
+        self._cache_size = max(1, cache_size)
+        self._ttl = ttl
+        self._decode = decode
+        self.hits = 0
+        self.misses = 0
+        self._logger = log.get_logger()
+        self._connection = Connection()
+        self._client = self._connection.connect()
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=False)
+        # key -> (value, expiry time or None), only for subscribed keys
+        self._cache = {}
+        # Keys subscribed to in LRU order, bounded by cache_size in
+        # _subscribe, and of those the confirmed ones with the number of
+        # the last subscription or message seen for each
+        self._subscribing = OrderedDict()
+        self._generation = {}
+        self._events = itertools.count()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._closed = False
+
+    def get(self, key):
+        """
+        Return the value of key, from the cache if it holds it
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._subscribing.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            if key in self._subscribing:
+                self._subscribing.move_to_end(key)
+            else:
+                self._subscribe(key)
+            generation = self._generation.get(key)
+        value = self._value(self._client.get(key))
+        if generation is None:
+            # Not confirmed yet, so a publish may have been missed
+            return value
+        with self._lock:
+            # Only cache the value if no publish came in meanwhile
+            if self._generation.get(key) == generation:
+                self._store(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Drop key, or every key, from the cache and unsubscribe from it
+        """
+        with self._lock:
+            keys = list(self._subscribing) if key is None else [key]
+            for key in keys:
+                if key in self._subscribing:
+                    self._unsubscribe(key)
+
+    def disconnect(self):
+        self._logger.info('Disconnecting Reader')
+        with self._lock:
+            self._closed = True
+            self._subscribing.clear()
+            listener = self._listener
+        self._pubsub.close()
+        if listener is not None:
+            listener.join()
+        self._connection.close()
+
+    def _value(self, raw):
+        if raw is None or not self._decode:
+            return raw
+        return decode(raw)
+
+    def _store(self, key, value):
+        """
+        Cache a value of a subscribed key. The cache is bounded by the
+        subscriptions: _subscribe unsubscribes the least recently used key
+        past cache_size, dropping its value. Called with _lock held.
+        """
+        expires = time.monotonic() + self._ttl if self._ttl else None
+        self._cache[key] = (value, expires)
+
+    def _subscribe(self, key):
+        """
+        Subscribe to key's channel, starting the listener if needed, and
+        unsubscribe the least recently used key if over cache_size.
+        Called with _lock held.
+        """
+        self._subscribing[key] = None
+        self._pubsub.subscribe(key)
+        while len(self._subscribing) > self._cache_size:
+            self._unsubscribe(next(iter(self._subscribing)))
+        if self._listener is None:
+            self._listener = threading.Thread(
+                target=self._listen,
+                args=(),
+                daemon=True)
+            self._listener.start()
+
+    def _unsubscribe(self, key):
+        """
+        Forget key and unsubscribe from its channel. Called with _lock held.
+        """
+        del self._subscribing[key]
+        self._cache.pop(key, None)
+        self._generation.pop(key, None)
+        self._pubsub.unsubscribe(key)
+
+    def _listen(self):
+        """
+        Apply subscription confirmations and published values. Blocks on
+        the pubsub connection, and exits once nothing is subscribed.
+        """
+        while True:
+            try:
+                for message in self._pubsub.listen():
+                    self._on_message(message)
+            except Exception as e:
+                with self._lock:
+                    if self._closed:
+                        self._listener = None
+                        return
+                    # Values may have been published while disconnected
+                    self._cache.clear()
+                self._logger.error('Reader subscription failed: %s' % e)
+                time.sleep(1)
+                continue
+            with self._lock:
+                if not self._pubsub.subscribed:
+                    self._listener = None
+                    return
+
+    def _on_message(self, message):
+        key = message['channel']
+        if isinstance(key, bytes):
+            key = key.decode()
+        with self._lock:
+            if key not in self._subscribing:
+                return
+            if message['type'] == 'subscribe':
+                self._generation[key] = next(self._events)
+            elif message['type'] == 'unsubscribe':
+                # Confirms an earlier unsubscribe of a key subscribed to
+                # again since, so wait for the new subscription
+                self._generation.pop(key, None)
+                self._cache.pop(key, None)
+            elif message['type'] == 'message':
+                self._generation[key] = next(self._events)
+                if key in self._cache:
+                    try:
+                        value = self._value(message['data'])
+                    except ValueError:
+                        del self._cache[key]
+                        return
+                    self._store(key, value)
@@ -2,7 +2,6 @@ import pika
 import nrtpygs.customlogger as log
 import os
 import threading
-import time
 
 # Connection parameters to the RabbitMQ server from ENV_VARS
 CREDENTIALS = pika.PlainCredentials(
@@ -11,24 +10,57 @@ CREDENTIALS = pika.PlainCredentials(
 
 RMQ_HOST = os.environ['RMQ_HOST']
 
+# Seconds to wait for a connection or channel to open before giving up
+CONNECT_TIMEOUT = float(os.getenv('RMQ_CONNECT_TIMEOUT', '30'))
+
+# Number of connections the process-wide connection manager multiplexes
+# client channels over, and the name they show on the broker
+RMQ_POOL_SIZE = int(os.getenv('RMQ_POOL_SIZE', '1'))
+RMQ_CONNECTION_NAME = os.getenv('RMQ_CONNECTION_NAME', 'nrtpygs')
+
+# Pools of the connection manager: consumers (whose callbacks run on the
+# ioloop) are kept apart from publishers and RPC clients (whose callers
+# block waiting on theirs)
+CONSUME = 'consume'
+PUBLISH = 'publish'
+
 
 class MqConnection():
     """
     Class to provide connection and new channel options to the rmq server
-    At present a single channel is opened and the object returned.
+    A default channel is opened on connect (unless default_channel is False)
+    and returned by get_channel(). Clients normally share connections
+    through connection_manager rather than creating their own.
     """
 
-    def __init__(self, source = 'Unknown'):
+    def __init__(self, source = 'Unknown', default_channel=True):
         self._stopping = False
+        self.connection = None
+        self.iothread = None
         self.channel = None
-        self.new_channel = None  # Non functional. See self.create_channel()
+        self.new_channel = None
         self.connection_name = source
+        self._default_channel = default_channel
+        self._on_open_callbacks = []
         self._logger = log.get_logger()
+        # Set from the ioloop callbacks, waited on by the client threads
+        self._connection_open = threading.Event()
+        self._channel_open = threading.Event()
+        self._connection_closed = threading.Event()
 
-    def connect(self):
+    def connect(self, timeout=CONNECT_TIMEOUT):
         """
         Create a connection, start the ioloop to connect
-        inside a thread and then return the connection
+        inside a thread and then return the connection once it is open.
+        Raises TimeoutError if the connection is not open within timeout
+        seconds (None waits forever).
+        """
+        self._start_connection()
+        return self.get_connection(timeout)
+
+    def _start_connection(self):
+        """
+        Create the SelectConnection and run its ioloop in a new thread
         """
         parameters = pika.ConnectionParameters(
             host=RMQ_HOST,
@@ -39,6 +71,7 @@ class MqConnection():
             heartbeat=600,
             blocked_connection_timeout=300,)
 
+        self._connection_closed.clear()
         self.connection = pika.SelectConnection(
             parameters=parameters,
             on_open_callback=self.on_connection_open,
@@ -46,47 +79,81 @@ class MqConnection():
             on_close_callback=self.on_connection_closed)
 
         self._logger.info('Connecting to %s', parameters.host)
+        # A daemon, so a connection still retrying does not keep the
+        # process alive
         self.iothread = threading.Thread(
             target=self.connection.ioloop.start,
-            args=())
+            args=(),
+            daemon=True)
         self.iothread.start()
-        # Wait to allow connection to open before returning
-        while not self.connection.is_open:
-            pass
-        return self.connection
 
-    def get_connection(self):
-        while not self.connection.is_open:
-            time.sleep(0.1)
-            pass
+    def get_connection(self, timeout=CONNECT_TIMEOUT):
+        """
+        Waits until the connection is open before returning the connection
+        handle. Raises TimeoutError if it is not open within timeout seconds.
+        """
+        if not self._connection_open.wait(timeout):
+            raise TimeoutError(
+                'Connection to {} not open after {}s'
+                .format(RMQ_HOST, timeout))
         return self.connection
 
-    def get_channel(self):
+    def get_channel(self, timeout=CONNECT_TIMEOUT):
         """
         Waits until channel is defined and open before returning the channel
-        handle.
-        Not elegent, but works
-        """
-        while self.channel is None:
-            time.sleep(0.01)
-            pass
-        while not self.channel.is_open:
-            time.sleep(0.01)
-            pass
+        handle. Raises TimeoutError if it is not open within timeout seconds.
+        """
+        if not self._channel_open.wait(timeout):
+            raise TimeoutError(
+                'Channel to {} not open after {}s'.format(RMQ_HOST, timeout))
         return self.channel
 
+    def add_on_open_callback(self, callback):
+        """
+        Register callback(connection) to run on the ioloop each time the
+        connection opens, including after a reconnect
+        """
+        self._on_open_callbacks.append(callback)
+
+    def remove_on_open_callback(self, callback):
+        if callback in self._on_open_callbacks:
+            self._on_open_callbacks.remove(callback)
+
     def on_connection_open(self, _unused_connection):
         self._logger.info('Connection opened')
-        self.channel = self.connection.channel()
+        self._connection_open.set()
+        if self._default_channel:
+            self._open_default_channel()
+        for callback in list(self._on_open_callbacks):
+            callback(self.connection)
         return
 
+    def _open_default_channel(self):
+        self.channel = self.connection.channel(
+            on_open_callback=self._on_default_channel_open)
+        self.channel.add_on_close_callback(self._on_default_channel_closed)
+
+    def _on_default_channel_open(self, channel):
+        self.on_channel_open(channel)
+        self._channel_open.set()
+
+    def _on_default_channel_closed(self, channel, reason):
+        """
+        Reopen the default channel if the broker closed it while the
+        connection stays up. Connection loss is handled by the reconnect.
+        """
+        self._channel_open.clear()
+        self.on_channel_closed(channel, reason)
+        if not self._stopping and self.connection.is_open:
+            self._open_default_channel()
+
     def on_connection_open_error(self, _unused_connection, err):
         """
         This method is called by pika if the connection to RabbitMQ
         can't be established.
         """
         self._logger.error('Connection open failed, trying again in 3 seconds: %s', err)
-        self.connection.ioloop.call_later(3, self.connect)
+        self.connection.ioloop.call_later(3, self._reconnect)
         return
 
     def on_connection_closed(self, _unused_connection, reason):
@@ -95,35 +162,65 @@ class MqConnection():
         closed unexpectedly. If it is unexpected, we will reconnect to
         RabbitMQ if it disconnects.
         """
+        self._connection_open.clear()
+        self._channel_open.clear()
         if self._stopping:
             self._logger.info('Connection closed by user')
             self.connection.ioloop.stop()
             self.connection = None
             self.channel = None
+            self._connection_closed.set()
         else:
             self._logger.warning(
                 'Connection closed unexpectedly, reopening in 1 second: %s',
                 reason)
-            self.connection.ioloop.call_later(1, self.connect)
+            self.connection.ioloop.call_later(1, self._reconnect)
 
-    def close(self):
+    def _reconnect(self):
+        """
+        Runs on the ioloop of the failed connection. That ioloop is stopped,
+        which ends its thread, and a new connection and thread are started.
+        """
+        self.connection.ioloop.stop()
+        if self._stopping:
+            self._connection_closed.set()
+            return
+        self._start_connection()
+
+    def close(self, timeout=CONNECT_TIMEOUT):
         self._logger.info('Closing Connection')
         self._stopping = True
-        if self.connection is not None:
-            self.connection.close()
+        if self.connection is None:
+            return
+        self.connection.ioloop.add_callback(self._close)
         # Block until connection closes
-        while self.connection.is_open:
-            pass
+        if not self._connection_closed.wait(timeout):
+            self._logger.warning(
+                'Connection did not close within {}s'.format(timeout))
 
-    def create_channel(self, channel_number=None, on_close_callback=None):
+    def _close(self):
+        """
+        Close the connection from the ioloop thread. A connection that is
+        not open (e.g. still retrying) has its ioloop stopped directly.
         """
-        NOTE: THIS IS NOT ACTIVE IN THE rmqconnectionAPI
-        Creating and returning channel handles outside of the ioloop structure
-        causes multithreading issues which cause frame errors.
-        See https://github.com/4mnrt/wp4-pdr-project/issues/23
+        try:
+            self.connection.close()
+        except pika.exceptions.ConnectionWrongStateError:
+            self.connection.ioloop.stop()
+            self._connection_closed.set()
+
+    def in_ioloop_thread(self):
+        return threading.current_thread() is self.iothread
 
+    def create_channel(self, channel_number=None, on_close_callback=None,
+                       on_open_callback=None, timeout=CONNECT_TIMEOUT):
+        """
         Creates a channel on the connection.
-        Once open returns the channel object
+        From any thread other than the ioloop the channel is opened on the
+        ioloop and the call blocks until it is open, then returns the
+        channel object. On the ioloop thread (i.e. inside a pika callback)
+        it cannot block, so the opening channel is returned straight away
+        and on_open_callback(channel) is called once it is open.
 
         on_close_callback can be specified to handle disconnections of
         the channel in a graceful way with your own function.
@@ -144,14 +241,45 @@ class MqConnection():
                 'The channel on_close_callback is default to RmqConnection')
             on_close_callback = self.on_channel_closed
 
-        self.new_channel = self.connection.channel(
-            on_open_callback=self.on_channel_open)
-        self.new_channel.add_on_close_callback(on_close_callback)
+        if self.in_ioloop_thread():
+            return self._open_channel(
+                channel_number, on_open_callback, on_close_callback)
+
+        opened = threading.Event()
+        channels = []
+
+        def on_open(channel):
+            if on_open_callback:
+                on_open_callback(channel)
+            opened.set()
+
+        self.get_connection(timeout).ioloop.add_callback(
+            lambda: channels.append(self._open_channel(
+                channel_number, on_open, on_close_callback))
+        )
         # Wait for channel to open before returning
-        while not self.new_channel.is_open:
-            pass
+        if not opened.wait(timeout):
+            raise TimeoutError(
+                'Channel to {} not open after {}s'.format(RMQ_HOST, timeout))
+        self.new_channel = channels[0]
         return self.new_channel
 
+    def _open_channel(self, channel_number, on_open_callback,
+                      on_close_callback):
+        """
+        Open a channel. Must be called on the ioloop thread.
+        """
+        def on_open(channel):
+            self.on_channel_open(channel)
+            if on_open_callback:
+                on_open_callback(channel)
+
+        channel = self.connection.channel(
+            channel_number=channel_number,
+            on_open_callback=on_open)
+        channel.add_on_close_callback(on_close_callback)
+        return channel
+
     def on_channel_open(self, channel):
         self._logger.info('Channel opened')
 
@@ -165,6 +293,228 @@ class MqConnection():
             self._logger.info('Channel %i was closed: %s', channel, reason)
 
 
+class MqChannelLease():
+    """
+    A client's share of a pooled MqConnection, handed out by
+    MqConnectionManager.lease(). It offers the same connect, get_connection,
+    get_channel, create_channel and close calls as MqConnection, but
+    get_channel() returns a channel owned by this lease and close() only
+    closes the lease's channels, releasing the connection back to the
+    manager. The lease channel is reopened when the connection reconnects.
+    forked is set on the leases a forked child inherits from its parent,
+    whose connections it cannot use.
+    """
+
+    def __init__(self, manager, rmqconnection: MqConnection, source):
+        self._manager = manager
+        self._rmqconnection = rmqconnection
+        self.connection_name = source
+        self.channel = None
+        self._channels = []
+        self._stopping = False
+        self.forked = False
+        self._channel_open = threading.Event()
+        self._logger = log.get_logger()
+        self._on_open_callbacks = [self._on_connection_open]
+        self._rmqconnection.add_on_open_callback(self._on_connection_open)
+
+    @property
+    def connection(self):
+        return self._rmqconnection.connection
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """
+        Wait for the shared connection to open, make sure the lease channel
+        is being opened and return the connection. Raises TimeoutError,
+        after releasing the lease, if it is not open within timeout seconds.
+        """
+        try:
+            connection = self._rmqconnection.get_connection(timeout)
+        except TimeoutError:
+            self.close()
+            raise
+        connection.ioloop.add_callback(self._open_lease_channel)
+        return connection
+
+    def get_connection(self, timeout=CONNECT_TIMEOUT):
+        return self._rmqconnection.get_connection(timeout)
+
+    def get_channel(self, timeout=CONNECT_TIMEOUT):
+        """
+        Waits until the lease channel is open before returning it.
+        Raises TimeoutError if it is not open within timeout seconds.
+        """
+        if not self._channel_open.wait(timeout):
+            raise TimeoutError(
+                'Channel for {} not open after {}s'
+                .format(self.connection_name, timeout))
+        return self.channel
+
+    def create_channel(self, channel_number=None, on_close_callback=None,
+                       on_open_callback=None, timeout=CONNECT_TIMEOUT):
+        """
+        Create an additional channel on the shared connection, see
+        MqConnection.create_channel(). It is closed with the lease.
+        """
+        channel = self._rmqconnection.create_channel(
+            channel_number=channel_number,
+            on_close_callback=on_close_callback,
+            on_open_callback=on_open_callback,
+            timeout=timeout)
+        self._channels = [c for c in self._channels if not c.is_closed]
+        self._channels.append(channel)
+        return channel
+
+    def add_on_open_callback(self, callback):
+        """
+        Register callback(connection) to run on the ioloop each time the
+        shared connection opens, until the lease is closed
+        """
+        self._on_open_callbacks.append(callback)
+        self._rmqconnection.add_on_open_callback(callback)
+
+    def in_ioloop_thread(self):
+        return self._rmqconnection.in_ioloop_thread()
+
+    def close(self, timeout=CONNECT_TIMEOUT):
+        """
+        Close the lease channels and release the shared connection
+        """
+        self._logger.info('Releasing {} channels'.format(self.connection_name))
+        self._stopping = True
+        for callback in self._on_open_callbacks:
+            self._rmqconnection.remove_on_open_callback(callback)
+        closed = threading.Event()
+        connection = self.connection
+        if connection is not None and connection.is_open:
+            connection.ioloop.add_callback(
+                lambda: (self._close_channels(), closed.set()))
+            if not closed.wait(timeout):
+                self._logger.warning(
+                    'Channels did not close within {}s'.format(timeout))
+        self._manager.release(self, timeout)
+
+    def _close_channels(self):
+        for channel in [self.channel] + self._channels:
+            if channel is not None and (channel.is_open or channel.is_opening):
+                channel.close()
+        self._channels = []
+
+    def _on_connection_open(self, connection):
+        self._open_lease_channel()
+
+    def _open_lease_channel(self):
+        """
+        Open the lease channel unless it is already open or opening.
+        Runs on the ioloop thread.
+        """
+        if self._stopping or not self.connection.is_open:
+            return
+        if self.channel is not None and \
+                (self.channel.is_open or self.channel.is_opening):
+            return
+        self.channel = self._rmqconnection.create_channel(
+            on_open_callback=self._on_lease_channel_open,
+            on_close_callback=self._on_lease_channel_closed)
+
+    def _on_lease_channel_open(self, channel):
+        self._channel_open.set()
+
+    def _on_lease_channel_closed(self, channel, reason):
+        """
+        Reopen the lease channel if the broker closed it while the
+        connection stays up. Connection loss is handled by the reconnect.
+        """
+        self._channel_open.clear()
+        self._rmqconnection.on_channel_closed(channel, reason)
+        if not self._stopping and self.connection is not None:
+            self._open_lease_channel()
+
+
+class MqConnectionManager():
+    """
+    Process-wide pools of MqConnections. Each client leases a channel
+    instead of opening its own connection and ioloop thread, so a process
+    needs at most pool_size connections to the broker per pool however
+    many producers, consumers and RPC clients it runs. Leases are spread
+    over their pool and a connection is closed when its last lease is
+    released.
+
+    Consumers lease from the CONSUME pool and publishers and RPC clients
+    from the PUBLISH pool, so a consumer callback running on its ioloop
+    can still wait on a publish confirm or an RPC response, which are
+    handled by the other pool's ioloop.
+    """
+
+    def __init__(self, pool_size=RMQ_POOL_SIZE, name=RMQ_CONNECTION_NAME):
+        self._pool_size = max(1, pool_size)
+        self._name = name
+        self._lock = threading.Lock()
+        # pool -> {connection: [leases]}
+        self._pools = {CONSUME: {}, PUBLISH: {}}
+        self._logger = log.get_logger()
+
+    def lease(self, source='Unknown', pool=PUBLISH):
+        """
+        Return an MqChannelLease on the least used connection of pool,
+        starting a new connection if the pool is not yet full
+        """
+        with self._lock:
+            leases = self._pools[pool]
+            if len(leases) < self._pool_size:
+                rmqconnection = MqConnection(
+                    '{}-{}-{}'.format(self._name, pool, len(leases)),
+                    default_channel=False)
+                rmqconnection._start_connection()
+                leases[rmqconnection] = []
+            else:
+                rmqconnection = min(leases, key=lambda c: len(leases[c]))
+            lease = MqChannelLease(self, rmqconnection, source)
+            leases[rmqconnection].append(lease)
+        self._logger.debug('Leased connection {} to {}'.format(
+            rmqconnection.connection_name, source))
+        return lease
+
+    def release(self, lease, timeout=CONNECT_TIMEOUT):
+        """
+        Release a lease, closing its connection if it was the last one
+        """
+        with self._lock:
+            rmqconnection = lease._rmqconnection
+            for pool in self._pools.values():
+                leases = pool.get(rmqconnection)
+                if leases is None:
+                    continue
+                if lease in leases:
+                    leases.remove(lease)
+                if leases:
+                    return
+                del pool[rmqconnection]
+                break
+            else:
+                return
+        rmqconnection.close(timeout)
+
+    def _after_fork(self):
+        """
+        Forget the parent's connections in a forked child. Their ioloop
+        threads do not survive the fork and their sockets belong to the
+        parent, so the child opens connections of its own. The leases
+        inherited from the parent are marked forked.
+        """
+        for pool in self._pools.values():
+            for leases in pool.values():
+                for lease in leases:
+                    lease.forked = True
+        self._lock = threading.Lock()
+        self._pools = {CONSUME: {}, PUBLISH: {}}
+
+
+# Shared by all clients in the process
+connection_manager = MqConnectionManager()
+os.register_at_fork(after_in_child=connection_manager._after_fork)
+
+
 def main():
     """
     Used for an example of how connection takes place and how to send a message
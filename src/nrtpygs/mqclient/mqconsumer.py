@@ -1,13 +1,48 @@
 import re
-from nrtpygs.mqclient.mqconnection import MqConnection
+from nrtpygs.mqclient.mqconnection import (
+    CONSUME, MqChannelLease, connection_manager
+)
+from nrtpygs.mqclient.mqdispatch import KeyedDispatcher, THREAD, PROCESS
+from nrtpygs.codec import decode
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import nrtpygs.customlogger as log
+from collections import deque
+import datetime
+import os
+import threading
+
+# Most unacknowledged messages (0 is no limit) and message bytes (0 is no
+# limit, RabbitMQ does not implement a size limit) the broker sends to
+# a consumer
+PREFETCH_COUNT = int(os.getenv('RMQ_PREFETCH_COUNT', '0'))
+PREFETCH_SIZE = int(os.getenv('RMQ_PREFETCH_SIZE', '0'))
+
+# With manual acks, send one multiple ack per this many handled messages,
+# or this many seconds after the first handled message not yet acked
+ACK_BATCH_SIZE = int(os.getenv('RMQ_ACK_BATCH_SIZE', '100'))
+ACK_INTERVAL = float(os.getenv('RMQ_ACK_INTERVAL', '0.1'))
+
+# Most messages in a batch from consume_batch(), and the longest wait in
+# seconds for a batch to fill
+BATCH_MAX_COUNT = int(os.getenv('RMQ_BATCH_MAX_COUNT', '100'))
+BATCH_MAX_LATENCY = float(os.getenv('RMQ_BATCH_MAX_LATENCY', '0.5'))
+
+# Prefetch per worker when dispatching to a pool without a prefetch_count
+PREFETCH_PER_WORKER = int(os.getenv('RMQ_PREFETCH_PER_WORKER', '2'))
+
+# NumPy is optional, used by unpack_frame_arrays when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class MqConsume():
     """
     Class to allow clients to subscribe to messages. On initiation the class
-    will create a connection. At that point a client can setup multiple
-    consumers using this connection. Each consumer has one queue, but can
-    specify multiple binding keys.
+    will lease the process-wide shared connection. At that point a client
+    can setup multiple consumers using this connection. Each consumer has
+    one channel and one queue, but can specify multiple binding keys.
 
     A new RmqConsumer object is created each time consume is called and stored
     This is required for future ability for consumers to detect when a channel
@@ -19,15 +54,44 @@ class MqConsume():
         - binding keys
         - queue_name
         - callback
+
+    With decode=True the callback receives the body decoded according to
+    the message content_type (see nrtpygs.codec) instead of raw bytes.
+
+    prefetch_count and prefetch_size set the consumer's basic_qos, bounding
+    the messages the broker pushes before they are acknowledged. With
+    auto_ack=False a message is acked once the callback returns, so one
+    being handled when the process dies is redelivered; a message whose
+    callback raises is rejected without requeueing. Acks are sent as a
+    single multiple ack per ack_batch messages or ack_interval seconds.
+
+    By default callbacks run on the connection's ioloop thread, so a slow
+    callback holds up every consumer and producer on the connection. With
+    workers > 0 messages are instead handed to a pool of that many threads
+    (worker_type='thread') or processes (worker_type='process'), and acked
+    when their callback finishes. Messages with the same routing key
+    (order_by='routing_key'), or all messages of the consumer
+    (order_by='queue'), are still handled one at a time in order;
+    order_by=None drops ordering. auto_ack defaults to False with workers,
+    and the prefetch count to workers * RMQ_PREFETCH_PER_WORKER, so the
+    messages held in the process stay bounded. Process workers need a
+    picklable (module level) callback and are passed None for the channel.
     """
 
+    # Whether consumers count the messages they receive (see MqConsumer)
+    _count_received = False
+
     def __init__(self):
-        self._connection = MqConnection('rmqconsumer')
+        self._connection = connection_manager.lease('rmqconsumer', CONSUME)
         self._connection.connect()
         self._consumers = []
 
     def consume(self, exchange, binding_keys, queue_name,
-                callback, durable=False, arguments=None):
+                callback, durable=False, arguments=None, decode=False,
+                prefetch_count=PREFETCH_COUNT, prefetch_size=PREFETCH_SIZE,
+                auto_ack=None, ack_batch=ACK_BATCH_SIZE,
+                ack_interval=ACK_INTERVAL, workers=0, worker_type=THREAD,
+                order_by='routing_key'):
         # Set the queuename to hold the service TLA prefix
         new_consumer = MqConsumer(
             self._connection,
@@ -36,7 +100,17 @@ class MqConsume():
             queue_name,
             callback,
             durable,
-            arguments
+            arguments,
+            decode,
+            prefetch_count=prefetch_count,
+            prefetch_size=prefetch_size,
+            auto_ack=auto_ack,
+            ack_batch=ack_batch,
+            ack_interval=ack_interval,
+            workers=workers,
+            worker_type=worker_type,
+            order_by=order_by,
+            count_received=self._count_received
         )
 
         self._consumers.append(new_consumer)
@@ -44,17 +118,69 @@ class MqConsume():
     def get_consumers(self):
         return self._consumers
 
+    def consume_batch(self, exchange, binding_keys, queue_name, callback,
+                      max_count=BATCH_MAX_COUNT,
+                      max_latency=BATCH_MAX_LATENCY, durable=False,
+                      arguments=None, decode=False,
+                      prefetch_count=PREFETCH_COUNT,
+                      prefetch_size=PREFETCH_SIZE, auto_ack=True):
+        """
+        Like consume(), but callback(messages) is called with a list of
+        (method, props, body) tuples once max_count messages have arrived,
+        or max_latency seconds after the first of them. With
+        auto_ack=False the batch is acked with a single multiple ack once
+        the callback returns, or every message in it is rejected if the
+        callback raises. The prefetch count then defaults to max_count.
+        """
+        new_consumer = MqBatchConsumer(
+            self._connection,
+            exchange,
+            binding_keys,
+            queue_name,
+            callback,
+            durable,
+            arguments,
+            decode,
+            prefetch_count=prefetch_count,
+            prefetch_size=prefetch_size,
+            auto_ack=auto_ack,
+            max_count=max_count,
+            max_latency=max_latency,
+            count_received=self._count_received
+        )
+
+        self._consumers.append(new_consumer)
+
     def disconnect(self):
+        # Let callbacks already handed to workers finish and be acked
+        for consumer in self._consumers:
+            consumer.shutdown()
         self._connection.close()
 
 
 class MqConsumer():
     """
-    The class for holding information on an individual consumer
+    The class for holding information on an individual consumer.
+
+    With manual acks, delivery tags are recorded in delivery order as
+    messages arrive and marked done by ack() from any thread. Only the
+    contiguous run of done tags at the front is acknowledged, with one
+    basic_ack(multiple=True) sent on the ioloop thread, so a message is
+    never acked before every earlier one has been handled. Rejected
+    messages are nacked individually in the same pass.
+
+    With count_received=True every message goes through _receive(),
+    which counts it in received on the ioloop thread before it is
+    handed on.
     """
 
-    def __init__(self, connection: MqConnection, exchange,
-                 binding_keys, queue_name, callback, durable, arguments):
+    def __init__(self, connection: MqChannelLease, exchange,
+                 binding_keys, queue_name, callback, durable, arguments,
+                 decode=False, prefetch_count=PREFETCH_COUNT,
+                 prefetch_size=PREFETCH_SIZE, auto_ack=None,
+                 ack_batch=ACK_BATCH_SIZE, ack_interval=ACK_INTERVAL,
+                 workers=0, worker_type=THREAD, order_by='routing_key',
+                 count_received=False):
         self._rmqconnection = connection
         self._connection = self._rmqconnection.get_connection()
         self._channel = None
@@ -64,13 +190,56 @@ class MqConsumer():
         self._callback = callback
         self._durable = durable
         self._arguments = arguments
+        self._decode = decode
+        self._count_received = count_received
+        self.received = 0
+        if order_by not in ('routing_key', 'queue', None):
+            raise ValueError('Unknown order_by {}'.format(order_by))
+        self._order_by = order_by
+        self._worker_type = worker_type
+        self._dispatcher = None
+        if workers:
+            if worker_type == THREAD:
+                executor = ThreadPoolExecutor(workers)
+            elif worker_type == PROCESS:
+                executor = ProcessPoolExecutor(workers)
+            else:
+                raise ValueError('Unknown worker_type {}'.format(worker_type))
+            self._dispatcher = KeyedDispatcher(executor)
+            if auto_ack is None:
+                auto_ack = False
+            if not prefetch_count:
+                prefetch_count = workers * PREFETCH_PER_WORKER
+        self._prefetch_count = prefetch_count
+        self._prefetch_size = prefetch_size
+        self._auto_ack = auto_ack is None or auto_ack
+        # Ack before the broker stops sending for want of acks
+        if prefetch_count:
+            ack_batch = min(ack_batch, max(1, prefetch_count // 2))
+        self._ack_batch = max(1, ack_batch)
+        self._ack_interval = ack_interval
+        # Delivery tags not yet acked, in delivery order, and those of them
+        # that have been handled. Guarded by _ack_lock, as is _rejected.
+        self._unacked = deque()
+        self._done = set()
+        # Rejected delivery tag -> requeue, nacked in delivery order
+        self._rejected = {}
+        self._ack_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._timer_scheduled = False
         self._logger = log.get_logger()
         self._setup_consume()
 
     def _setup_consume(self):
         self._create_channel()
+        # Channel methods are only safe on the ioloop thread. Pika queues
+        # the declare, binds and consume so they run in order.
+        self._connection.ioloop.add_callback(self._declare_and_consume)
+
+    def _declare_and_consume(self):
         self._create_queue()
         self._setup_bindings()
+        self._set_qos()
         self._consume()
 
     def _create_channel(self):
@@ -96,6 +265,13 @@ class MqConsumer():
                 routing_key=binding_key
             )
 
+    def _set_qos(self):
+        if self._prefetch_count or self._prefetch_size:
+            self._channel.basic_qos(
+                prefetch_size=self._prefetch_size,
+                prefetch_count=self._prefetch_count
+            )
+
     def _consume(self):
         """
         We set the basic consume and set the callback,
@@ -105,12 +281,303 @@ class MqConsumer():
         self._logger.debug('Starting consume')
         self._channel.basic_consume(
             queue=self._queue_name,
-            on_message_callback=self._callback,
-            auto_ack=True
+            on_message_callback=self._message_callback(),
+            auto_ack=self._auto_ack
         )
 
+    def _message_callback(self):
+        """
+        The callback to give basic_consume. Messages only go through
+        _on_message when there is something to do besides the callback.
+        """
+        if self._decode or not self._auto_ack or self._dispatcher \
+                or self._count_received:
+            return self._on_message
+        return self._callback
+
+    def _receive(self, method, props, body):
+        """
+        Record a delivery for acking and return its body, decoded if asked
+        to. Raises ValueError, after rejecting the message, if the body
+        cannot be decoded.
+        """
+        self.received += 1
+        if not self._auto_ack:
+            with self._ack_lock:
+                self._unacked.append(method.delivery_tag)
+        if not self._decode:
+            return body
+        try:
+            return decode(body, props.content_type)
+        except ValueError as e:
+            self._logger.error(
+                'Unable to decode message on {}: {}'
+                .format(method.routing_key, e))
+            if not self._auto_ack:
+                self.reject(method.delivery_tag)
+            raise
+
+    def _on_message(self, ch, method, props, body):
+        """
+        Decode the body if asked to, hand the message to the callback and
+        ack it when done if acks are manual
+        """
+        tag = method.delivery_tag
+        try:
+            body = self._receive(method, props, body)
+        except ValueError:
+            return
+        if self._dispatcher is not None:
+            self._dispatch(ch, method, props, body)
+            return
+        if self._auto_ack:
+            self._callback(ch, method, props, body)
+            return
+        try:
+            self._callback(ch, method, props, body)
+        except Exception:
+            self._logger.exception(
+                'Consumer callback failed on {}'.format(method.routing_key))
+            self.reject(tag)
+            return
+        self.ack(tag)
+
+    def _dispatch(self, ch, method, props, body):
+        """
+        Hand the message to the worker pool, keyed for ordering
+        """
+        if self._order_by == 'routing_key':
+            key = method.routing_key
+        elif self._order_by == 'queue':
+            key = self._queue_name
+        else:
+            key = None
+        if self._worker_type == PROCESS:
+            ch = None
+        tag = method.delivery_tag
+        routing_key = method.routing_key
+
+        def on_done(future):
+            if future.exception() is not None:
+                self._logger.error(
+                    'Consumer callback failed on {}: {}'
+                    .format(routing_key, future.exception()))
+                if not self._auto_ack:
+                    self.reject(tag)
+            elif not self._auto_ack:
+                self.ack(tag)
+        self._dispatcher.submit(
+            key, self._callback, (ch, method, props, body), on_done)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker pool, if any, after the callbacks handed to it have
+        finished, and send the remaining acks
+        """
+        if self._dispatcher is None:
+            return
+        self._dispatcher.shutdown(wait)
+        if not self._auto_ack:
+            self._connection.ioloop.add_callback(self._flush_acks)
+
+    def ack(self, delivery_tag):
+        """
+        Mark a message as handled. Safe to call from any thread. The ack is
+        sent with the next batch.
+        """
+        with self._ack_lock:
+            self._done.add(delivery_tag)
+            if len(self._done) >= self._ack_batch:
+                if self._flush_scheduled:
+                    return
+                self._flush_scheduled = True
+                callback = self._flush_acks
+            else:
+                if self._timer_scheduled or self._flush_scheduled:
+                    return
+                self._timer_scheduled = True
+                callback = self._start_ack_timer
+        self._connection.ioloop.add_callback(callback)
+
+    def reject(self, delivery_tag, requeue=False):
+        """
+        Reject a message. Safe to call from any thread. The nack is sent in
+        delivery order, once the messages before it have been handled.
+        """
+        with self._ack_lock:
+            self._rejected[delivery_tag] = requeue
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._connection.ioloop.add_callback(self._flush_acks)
+
+    def _start_ack_timer(self):
+        self._connection.ioloop.call_later(
+            self._ack_interval, self._on_ack_timer)
+
+    def _on_ack_timer(self):
+        with self._ack_lock:
+            self._timer_scheduled = False
+        self._flush_acks()
+
+    def _flush_acks(self):
+        """
+        Ack the handled messages at the front of the delivery order with
+        one multiple ack, nacking any rejected ones among them in turn.
+        Runs on the ioloop thread.
+        """
+        # (ack, delivery_tag, requeue) in the order to send them
+        sends = []
+        last = None
+        with self._ack_lock:
+            self._flush_scheduled = False
+            while self._unacked:
+                tag = self._unacked[0]
+                if tag in self._rejected:
+                    if last is not None:
+                        sends.append((True, last, None))
+                        last = None
+                    sends.append((False, tag, self._rejected.pop(tag)))
+                elif tag in self._done:
+                    self._done.discard(tag)
+                    last = tag
+                else:
+                    break
+                self._unacked.popleft()
+            if last is not None:
+                sends.append((True, last, None))
+            if (self._done or self._rejected) and not self._timer_scheduled:
+                # Handled out of order, try again once earlier ones are done
+                self._timer_scheduled = True
+                self._connection.ioloop.call_later(
+                    self._ack_interval, self._on_ack_timer)
+        if not self._channel.is_open:
+            return
+        for ack, tag, requeue in sends:
+            if ack:
+                self._channel.basic_ack(delivery_tag=tag, multiple=True)
+            else:
+                self._channel.basic_nack(delivery_tag=tag, requeue=requeue)
+
+
+class MqBatchConsumer(MqConsumer):
+    """
+    A consumer handing messages to its callback in batches, see
+    MqConsume.consume_batch(). Batches are gathered and handed over on
+    the ioloop thread.
+    """
+
+    def __init__(self, connection: MqChannelLease, exchange,
+                 binding_keys, queue_name, callback, durable, arguments,
+                 decode=False, prefetch_count=PREFETCH_COUNT,
+                 prefetch_size=PREFETCH_SIZE, auto_ack=True,
+                 max_count=BATCH_MAX_COUNT, max_latency=BATCH_MAX_LATENCY,
+                 count_received=False):
+        self._max_count = max(1, max_count)
+        self._max_latency = max_latency
+        self._batch = []
+        self._batch_timer = None
+        if not auto_ack and not prefetch_count:
+            prefetch_count = self._max_count
+        super().__init__(
+            connection, exchange, binding_keys, queue_name, callback,
+            durable, arguments, decode, prefetch_count=prefetch_count,
+            prefetch_size=prefetch_size, auto_ack=auto_ack,
+            ack_batch=self._max_count, count_received=count_received)
+
+    def shutdown(self, wait=True):
+        """
+        Hand over the batch gathered so far
+        """
+        self._connection.ioloop.add_callback(self._deliver_batch)
+
+    def _message_callback(self):
+        return self._on_message
+
+    def _on_message(self, ch, method, props, body):
+        try:
+            body = self._receive(method, props, body)
+        except ValueError:
+            return
+        self._batch.append((method, props, body))
+        if len(self._batch) >= self._max_count:
+            self._deliver_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = self._connection.ioloop.call_later(
+                self._max_latency, self._on_batch_timer)
+
+    def _on_batch_timer(self):
+        self._batch_timer = None
+        self._deliver_batch()
+
+    def _deliver_batch(self):
+        """
+        Hand the batch to the callback and ack or reject all of it
+        """
+        if self._batch_timer is not None:
+            self._connection.ioloop.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        batch = self._batch
+        if not batch:
+            return
+        self._batch = []
+        if self._auto_ack:
+            self._callback(batch)
+            return
+        try:
+            self._callback(batch)
+        except Exception:
+            self._logger.exception(
+                'Batch consumer callback failed on {} messages from {}'
+                .format(len(batch), self._queue_name))
+            with self._ack_lock:
+                for method, _, _ in batch:
+                    self._rejected[method.delivery_tag] = False
+        else:
+            with self._ack_lock:
+                self._done.update(
+                    method.delivery_tag for method, _, _ in batch)
+        self._flush_acks()
+
+
+def unpack_frame(body, content_type=None):
+    """
+    Return the samples in a packed telemetry frame (see MqTelemetry) as
+    tel message dicts. body may be the raw message body or the already
+    decoded frame.
+    """
+    if isinstance(body, (bytes, bytearray, memoryview, str)):
+        body = decode(body, content_type)
+    return [
+        {
+            'type': 'tel',
+            'timestamp': datetime.datetime.utcfromtimestamp(stamp).strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            'name': name,
+            'value': value,
+        }
+        for name, value, stamp in zip(
+            body['names'], body['values'], body['timestamps'])
+    ]
+
+
+def unpack_frame_arrays(body, content_type=None):
+    """
+    Return the names, values and unix timestamps columns of a packed
+    telemetry frame. The columns are NumPy arrays when NumPy is installed
+    and lists otherwise.
+    """
+    if isinstance(body, (bytes, bytearray, memoryview, str)):
+        body = decode(body, content_type)
+    names, values, stamps = body['names'], body['values'], body['timestamps']
+    if numpy is None:
+        return names, values, stamps
+    return numpy.asarray(names), numpy.asarray(values), \
+        numpy.asarray(stamps, dtype=numpy.float64)
+
 
 class ExampleConsume():
+
     """
     Example usage of RmqConsumer
     """
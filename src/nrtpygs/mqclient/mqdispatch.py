@@ -0,0 +1,64 @@
+from collections import deque
+import threading
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+class KeyedDispatcher():
+    """
+    Runs calls on a concurrent.futures executor while keeping calls with
+    the same key in order: a call only starts once the previous call for
+    its key has finished, while calls for different keys run concurrently
+    up to the executor's max_workers. A key of None is never ordered.
+
+    on_done(future) is called for every call as it finishes, from the
+    executor's thread (or its result thread for a process pool).
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # key -> calls waiting for the running call with that key
+        self._backlogs = {}
+
+    def submit(self, key, fn, args, on_done):
+        if key is not None:
+            with self._lock:
+                backlog = self._backlogs.get(key)
+                if backlog is not None:
+                    backlog.append((fn, args, on_done))
+                    return
+                self._backlogs[key] = deque()
+        self._start(key, fn, args, on_done)
+
+    def shutdown(self, wait=True):
+        """
+        Shut the executor down, with wait first letting every ordered call
+        already submitted run
+        """
+        if wait:
+            with self._idle:
+                while self._backlogs:
+                    self._idle.wait()
+        self._executor.shutdown(wait)
+
+    def _start(self, key, fn, args, on_done):
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(
+            lambda done: self._finished(key, done, on_done))
+
+    def _finished(self, key, future, on_done):
+        on_done(future)
+        if key is None:
+            return
+        with self._lock:
+            backlog = self._backlogs[key]
+            if not backlog:
+                del self._backlogs[key]
+                if not self._backlogs:
+                    self._idle.notify_all()
+                return
+            call = backlog.popleft()
+        self._start(key, *call)
@@ -1,119 +1,80 @@
 import datetime
 import pika
-from nrtpygs.mqclient.mqconnection import MqConnection
-import nrtpygs.customlogger as log
-from queue import Queue
-import json
-import time
-import threading
+from nrtpygs.mqclient.mqpublisher import (
+    MqPublisher, PUBLISH_BATCH_SIZE, PUBLISH_BATCH_BYTES,
+    PUBLISH_MAX_INFLIGHT, PUBLISH_QUEUE_SIZE, PUBLISH_QUEUE_BYTES,
+    PUBLISH_QUEUE_TIMEOUT
+)
+from nrtpygs.mqclient.mqspill import SPILL_SEGMENT_BYTES
+from nrtpygs.codec import get_codec
+from concurrent.futures import Future
+import os
 
+# Directory for MqProducer to spill messages to disk when its queue is full
+SPILL_DIR = os.getenv('RMQ_SPILL_DIR')
 
-class MqProducer():
 
-    def __init__(self, exchange='sequencer', routing_key='rmq.sequencer'):
-        self._sent = 0
-        self._sending_message = False
-        self._stopping = False
-        self._await_reconnect = False
-        self._rmqconnection = MqConnection('producer')
-        self._connection = self._rmqconnection.connect()
-        self._channel = self._rmqconnection.get_channel()
-        self._prodq = Queue(maxsize=0)
-        self.exchange = exchange
-        self.routing_key = routing_key
-        self._logger = log.get_logger()
+class MqProducer(MqPublisher):
+    """
+    Publish messages to an exchange with a fixed routing key. Messages are
+    queued by produce() and published in batches, see MqPublisher.
+    They are serialised with codec (see nrtpygs.codec, default json),
+    which is declared to consumers in the content_type property.
+
+    With confirm=True publisher confirms are used and produce() returns a
+    concurrent.futures.Future resolved when the broker acks the message
+    (or failed with pika.exceptions.NackError if it is nacked). Up to
+    max_inflight messages are pipelined awaiting confirms. The futures
+    are resolved on the ioloop thread, so callbacks added to them must
+    not block.
+
+    The queue holds at most queue_size messages / queue_bytes bytes. When
+    full, queue_policy decides what happens (see mqqueue.BoundedQueue);
+    the default blocks produce() for up to queue_timeout seconds
+    (RMQ_PUBLISH_QUEUE_TIMEOUT) and then raises queue.Full. Dropped messages fail their future with queue.Full.
+
+    With spill_dir set (or RMQ_SPILL_DIR) messages that do not fit in the
+    queue are spilled to segment files of spill_segment_bytes in that
+    directory instead of blocking, and replayed in order once the broker
+    is back; see mqspill.SpillQueue. Messages spilled by a previous run
+    are replayed on start up. Each producer needs its own spill_dir.
+    """
 
-        # Set up publish message thread.
-        self._prodThread = threading.Thread(
-            target=self._publish_message_loop,
-            args=())
-        self._prodThread.start()
+    def __init__(self, exchange='sequencer', routing_key='rmq.sequencer',
+                 batch_size=PUBLISH_BATCH_SIZE,
+                 batch_bytes=PUBLISH_BATCH_BYTES,
+                 confirm=False, max_inflight=PUBLISH_MAX_INFLIGHT,
+                 queue_size=PUBLISH_QUEUE_SIZE,
+                 queue_bytes=PUBLISH_QUEUE_BYTES,
+                 queue_policy='block',
+                 queue_timeout=PUBLISH_QUEUE_TIMEOUT,
+                 spill_dir=SPILL_DIR,
+                 spill_segment_bytes=SPILL_SEGMENT_BYTES, codec=None):
+        self.routing_key = routing_key
+        self._codec = get_codec(codec)
+        properties = pika.BasicProperties(
+            content_type=self._codec.content_type,
+            delivery_mode=2,
+        )
+        super().__init__('producer', exchange, properties,
+                         batch_size, batch_bytes, confirm, max_inflight,
+                         queue_size, queue_bytes, queue_policy,
+                         queue_timeout, spill_dir, spill_segment_bytes)
+        self._prodq = self._queue
 
     def produce(self, message):
         """
-        Add message to python queue
+        Add message to python queue. In confirm mode returns a Future for
+        the broker confirm, otherwise None.
         """
         time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
         body = {
             'timestamp': time,
             'message': message,
         }
-        self._prodq.put(body)
-
-    def disconnect(self):
-        self._logger.info('Disconnecting Production Connection')
-        self._stopping = True
-        # Wait for all messages to be sent
-
-        while not self._prodq.empty():
-            time.sleep(0.1)
-            pass
-        # Allow extra time for remaining messages to purge
-        time.sleep(0.5)
-        # Close the connection and rejoin the log thread
-        self._rmqconnection.close()
-        self._prodThread.join()
-
-    def _await_new_channel(self):
-        """
-        Await RmqConnection to reconnect and create a new channel
-        """
-        self._logger.info('Awaiting channel recreation')
-        self._logger.debug('Waiting on connection to reopen')
-        self._connection = self._rmqconnection.get_connection()
-        self._logger.debug('Connection is open again')
-        self._channel = self._rmqconnection.get_channel()
-        self._logger.debug('Channel is open again')
-        self._await_reconnect = False
-
-    def _publish_message_loop(self):
-        """
-        Single thread function to read prodq and publish messages
-        """
-        self._logger.debug('Starting publish message loop')
-        while True:
-            # Stop the loop consuming all resource
-            # max rate 10kHz
-            time.sleep(0.0001)
-            if self._await_reconnect:
-                self._await_new_channel()
-
-            if not self._prodq.empty() and not self._sending_message:
-                self._sending_message = True
-                self._connection.ioloop.add_callback(self._publish_message)
-                self._sent += 1
-                if self._sent % 1000 == 0:
-                    self._logger.debug(
-                        'Published {} messages. Queuesize is {}'
-                        .format(self._sent, self._prodq.qsize())
-                    )
-
-            if self._prodq.empty() and self._stopping:
-                break
-
-    def _publish_message(self):
-        """
-        Publish message in a loop until it is sent. If there is an exception
-        then recreate the send channel on the autoreconnected connection
-        """
-        body = self._prodq.get(block=True, timeout=None)
-        try:
-            self._channel.basic_publish(
-                exchange=self.exchange,
-                routing_key=self.routing_key,
-                properties=pika.BasicProperties(
-                    content_type='json',
-                    delivery_mode=2,
-                ),
-                body=json.dumps(body)
-            )
-
-        except pika.exceptions.ChannelWrongStateError:
-            self._logger.error(
-                'Error sending message (ChannelWrongState), reconnecting'
-            )
-            self._await_reconnect = True
-        self._sending_message = False
+        future = Future() if self._confirm else None
+        self._enqueue(self.routing_key, self._codec.encode(body), future)
+        return future
 
 
 def main():
@@ -0,0 +1,462 @@
+from nrtpygs.mqclient.mqconnection import CONNECT_TIMEOUT, connection_manager
+from nrtpygs.mqclient.mqqueue import BoundedQueue
+from nrtpygs.mqclient.mqspill import SpillQueue, SPILL_SEGMENT_BYTES
+import nrtpygs.customlogger as log
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import pika
+import os
+import queue
+import threading
+
+# Most messages, and bytes of message body, published per ioloop callback
+PUBLISH_BATCH_SIZE = int(os.getenv('RMQ_PUBLISH_BATCH_SIZE', '500'))
+PUBLISH_BATCH_BYTES = int(os.getenv('RMQ_PUBLISH_BATCH_BYTES', '1048576'))
+
+# Most published messages awaiting a broker confirm in confirm mode
+PUBLISH_MAX_INFLIGHT = int(os.getenv('RMQ_PUBLISH_MAX_INFLIGHT', '1000'))
+
+# Capacity of the publish queue in messages and in bytes (0 is unbounded)
+PUBLISH_QUEUE_SIZE = int(os.getenv('RMQ_PUBLISH_QUEUE_SIZE', '100000'))
+PUBLISH_QUEUE_BYTES = int(os.getenv('RMQ_PUBLISH_QUEUE_BYTES', '0'))
+
+# Seconds a publish blocks on a full queue under the block policy before
+# raising queue.Full
+PUBLISH_QUEUE_TIMEOUT = float(os.getenv('RMQ_PUBLISH_QUEUE_TIMEOUT',
+                                        str(CONNECT_TIMEOUT)))
+
+# Seconds the publisher thread blocks on an empty queue, or on a batch
+# in flight, before checking whether it is stopping or the connection died
+_IDLE_TIMEOUT = 0.5
+
+
+class MqPublisher():
+    """
+    Base class for MqProducer and MqTelemetry.
+
+    Messages are serialised by the caller and put on a BoundedQueue, which
+    applies the backpressure policy when it is full (see mqqueue). A
+    publisher thread blocks on the queue until a message arrives. It then
+    drains up to batch_size messages or batch_bytes of serialised body and
+    hands them to a single ioloop callback to publish, so the ioloop is
+    woken once per batch rather than once per message. One batch is in
+    flight at a time.
+    Queued messages are (exchange, routing_key, properties, payload,
+    future) tuples, made by _enqueue().
+
+    In confirm mode the channel is put into publisher confirm mode and
+    publishes are pipelined: up to max_inflight messages may await a
+    confirm at once. Each message's future (if any) gets its result when
+    the broker acks it, or a pika.exceptions.NackError when it is nacked.
+    Messages still unconfirmed when the channel is lost are republished
+    on the new channel.
+
+    With a spill directory, messages that do not fit in the queue are
+    written to a SpillQueue on disk instead (see mqspill), as are all
+    messages after them until the spill has been replayed, so order is
+    kept. Spilled messages are published once the queue is empty and the
+    channel is up, and removed from disk once published (or confirmed in
+    confirm mode). A spilled message the broker nacks stays on disk and
+    is published again, its future only resolving once it is confirmed.
+    The queue policy must be block; spilling happens
+    instead of blocking.
+    """
+
+    def __init__(self, source, exchange, properties,
+                 batch_size=PUBLISH_BATCH_SIZE,
+                 batch_bytes=PUBLISH_BATCH_BYTES,
+                 confirm=False, max_inflight=PUBLISH_MAX_INFLIGHT,
+                 queue_size=PUBLISH_QUEUE_SIZE,
+                 queue_bytes=PUBLISH_QUEUE_BYTES,
+                 queue_policy='block', queue_timeout=PUBLISH_QUEUE_TIMEOUT,
+                 spill_dir=None, spill_segment_bytes=SPILL_SEGMENT_BYTES):
+        self._sent = 0
+        self._stopping = False
+        self._await_reconnect = False
+        self._logger = log.get_logger()
+        self.exchange = exchange
+        self._properties = properties
+        self._queue = self._make_queue(
+            queue_size, queue_bytes, queue_policy, queue_timeout)
+        self._batch_size = max(1, batch_size)
+        self._batch_bytes = batch_bytes
+        # Messages from a failed batch, published first after reconnecting
+        self._unsent = []
+        self._inflight = None
+        self._inflight_lock = threading.Lock()
+        self._batch_done = threading.Event()
+        # Confirm mode: delivery tag -> message awaiting an ack or nack.
+        # Guarded by _window, which is notified as confirms arrive.
+        self._confirm = confirm
+        self._max_inflight = max(1, max_inflight)
+        self._pending = OrderedDict()
+        self._delivery_tag = 0
+        self._window = threading.Condition()
+        self._spill = None
+        if spill_dir:
+            if queue_policy != 'block':
+                raise ValueError('Spilling to disk needs the block policy')
+            self._spill = SpillQueue(spill_dir, spill_segment_bytes)
+            # Futures of messages spilled by this process, in spill order
+            self._spill_futures = deque()
+            self._spill_lock = threading.Lock()
+            # Spilled messages nacked by the broker, to be sent again
+            self._nacked = deque()
+        self._rmqconnection = connection_manager.lease(source)
+        self._connection = self._rmqconnection.connect()
+        try:
+            self._channel = self._rmqconnection.get_channel()
+        except TimeoutError:
+            self._rmqconnection.close()
+            raise
+        self._select_confirm()
+
+        # Set up publish message thread.
+        self._publishThread = threading.Thread(
+            target=self._publish_message_loop,
+            args=())
+        self._publishThread.start()
+
+    def disconnect(self):
+        self._logger.info('Disconnecting {} Connection'.format(
+            self._rmqconnection.connection_name))
+        self._stopping = True
+        # The publish thread exits once all messages have been sent
+        self._publishThread.join()
+        self._rmqconnection.close()
+        if self._spill is not None:
+            self._spill.close()
+
+    @property
+    def dropped(self):
+        """Messages dropped because the publish queue was full"""
+        return self._queue.dropped
+
+    @property
+    def coalesced(self):
+        """Messages replaced by a newer one with the same routing key"""
+        return self._queue.coalesced
+
+    def _make_queue(self, queue_size, queue_bytes, queue_policy,
+                    queue_timeout):
+        """
+        Create the publish queue. Subclasses may return a LaneQueue.
+        """
+        return BoundedQueue(
+            queue_size, queue_bytes, queue_policy, queue_timeout,
+            on_displaced=self._on_displaced)
+
+    def _enqueue(self, routing_key, payload, future=None, properties=None,
+                 lane=None):
+        """
+        Queue a serialised payload for publishing, with the publisher's
+        properties unless others are given. lane names the LaneQueue lane
+        to use, if the queue has lanes. Raises queue.Full if the queue
+        policy is block and there is no room within the timeout.
+        """
+        self._check_fork()
+        message = (
+            self.exchange, routing_key, properties or self._properties,
+            payload, future)
+        if lane is not None:
+            self._queue.put(
+                message, key=routing_key, size=len(payload), lane=lane)
+            return
+        if self._spill is None:
+            self._queue.put(message, key=routing_key, size=len(payload))
+            return
+        with self._spill_lock:
+            if self._spill.empty():
+                try:
+                    self._queue.put(
+                        message, key=routing_key, size=len(payload),
+                        timeout=0)
+                    return
+                except queue.Full:
+                    self._logger.warning('Publish queue full, spilling')
+            self._spill_futures.append(future)
+            try:
+                self._spill.write(routing_key, payload)
+            except Exception:
+                self._spill_futures.pop()
+                raise
+
+    def _enqueue_many(self, messages, properties=None, lane=None):
+        """
+        Queue a list of (routing_key, payload) messages in one go, as
+        _enqueue() does for one
+        """
+        self._check_fork()
+        properties = properties or self._properties
+        if self._spill is not None:
+            for routing_key, payload in messages:
+                self._enqueue(routing_key, payload, properties=properties)
+            return
+        entries = [
+            ((self.exchange, routing_key, properties, payload, None),
+             routing_key, len(payload))
+            for routing_key, payload in messages
+        ]
+        if lane is not None:
+            self._queue.put_many(entries, lane=lane)
+        else:
+            self._queue.put_many(entries)
+
+    def _check_fork(self):
+        """
+        Raise RuntimeError in a forked child, where the publisher thread
+        and connection of a publisher made by the parent do not exist
+        """
+        if self._rmqconnection.forked:
+            raise RuntimeError(
+                '{} was created before the process forked and cannot '
+                'publish from the child'.format(type(self).__name__))
+
+    def _on_displaced(self, message, replacement):
+        """
+        Fail the future of a message dropped from the full queue. A
+        coalesced message's future follows the message that replaced it.
+        """
+        future = message[4]
+        if future is None:
+            return
+        if replacement is not None and replacement[4] is not None:
+            replacement[4].add_done_callback(
+                lambda done: _copy_future(done, future))
+        else:
+            future.set_exception(
+                queue.Full('Message dropped from full publish queue'))
+
+    def _select_confirm(self):
+        """
+        In confirm mode, turn on publisher confirms for the current channel.
+        Scheduled on the ioloop ahead of any publish on the channel.
+        """
+        if not self._confirm:
+            return
+        channel = self._channel
+
+        def select():
+            with self._window:
+                self._delivery_tag = 0
+            channel.confirm_delivery(self._on_delivery_confirmation)
+        self._connection.ioloop.add_callback(select)
+
+    def _on_delivery_confirmation(self, frame):
+        """
+        Resolve the futures of messages acked or nacked by the broker.
+        A multiple confirm covers every tag up to and including its own.
+        """
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self._window:
+            if method.multiple:
+                tags = [tag for tag in self._pending
+                        if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag]
+            messages = [self._pending.pop(tag, None) for tag in tags]
+            self._window.notify_all()
+        for message in messages:
+            if message is None or message[4] is None:
+                continue
+            if acked:
+                message[4].set_result(True)
+            else:
+                message[4].set_exception(
+                    pika.exceptions.NackError([message]))
+        if not acked:
+            self._logger.error(
+                'Broker nacked {} message(s)'.format(len(messages)))
+
+    def _window_room(self):
+        """
+        How many messages the next batch may hold. In confirm mode this
+        blocks while max_inflight messages are unconfirmed.
+        """
+        if not self._confirm:
+            return self._batch_size
+        with self._window:
+            room = self._max_inflight - len(self._pending)
+            if room <= 0 and not self._await_reconnect:
+                self._window.wait(_IDLE_TIMEOUT)
+                room = self._max_inflight - len(self._pending)
+        if self._pending and not self._channel.is_open:
+            # The confirms will never arrive, republish on a new channel
+            self._await_reconnect = True
+            return 0
+        return max(0, min(room, self._batch_size))
+
+    def _await_new_channel(self):
+        """
+        Await RmqConnection to reconnect and create a new channel
+        """
+        self._logger.info('Awaiting channel recreation')
+        self._logger.debug('Waiting on connection to reopen')
+        try:
+            self._connection = self._rmqconnection.get_connection()
+            self._logger.debug('Connection is open again')
+            self._channel = self._rmqconnection.get_channel()
+        except TimeoutError as e:
+            # Leave _await_reconnect set so the loop tries again
+            self._logger.warning('Still awaiting channel: {}'.format(e))
+            return
+        self._logger.debug('Channel is open again')
+        with self._window:
+            # Unconfirmed messages from the old channel are sent again
+            self._unsent = list(self._pending.values()) + self._unsent
+            self._pending.clear()
+        self._select_confirm()
+        self._await_reconnect = False
+
+    def _publish_message_loop(self):
+        """
+        Single thread function to read the queue and publish batches
+        """
+        self._logger.debug('Starting publish message loop')
+        while True:
+            if self._await_reconnect:
+                self._await_new_channel()
+                continue
+
+            batch = self._next_batch()
+            if batch:
+                sent = self._sent
+                self._send_batch(batch)
+                if self._sent // 1000 > sent // 1000:
+                    self._logger.debug(
+                        'Published {} messages. Queuesize is {}'
+                        .format(self._sent, self._queue.qsize())
+                    )
+            elif self._stopping and not self._unsent and not self._pending \
+                    and (self._spill is None or self._spill.settled()):
+                break
+
+    def _next_batch(self):
+        """
+        Block until there is a message to send, then drain the queue up to
+        the batch limits, topping up from the spill once the queue is
+        empty. Returns an empty list if there was nothing to send.
+        """
+        limit = self._window_room()
+        if limit == 0:
+            return []
+        while self._spill is not None and self._nacked:
+            self._unsent.append(self._spill_message(*self._nacked.popleft()))
+        batch = self._unsent[:limit]
+        self._unsent = self._unsent[limit:]
+        size = sum(len(message[3]) for message in batch)
+        spilled = self._spill is not None and not self._spill.empty()
+        if not batch and not spilled:
+            try:
+                message = self._queue.get(timeout=_IDLE_TIMEOUT)
+            except queue.Empty:
+                return batch
+            batch.append(message)
+            size += len(message[3])
+        while len(batch) < limit and size < self._batch_bytes:
+            try:
+                message = self._queue.get_nowait()
+            except queue.Empty:
+                message = self._read_spill() if spilled else None
+                if message is None:
+                    break
+            batch.append(message)
+            size += len(message[3])
+        return batch
+
+    def _read_spill(self):
+        """
+        Take the next spilled message to publish
+        """
+        record = self._spill.read()
+        if record is None:
+            return None
+        segment, routing_key, payload = record
+        future = None
+        if segment >= self._spill.first_segment:
+            future = self._spill_futures.popleft()
+        message = (self.exchange, routing_key, self._properties, payload)
+        return self._spill_message(message, segment, future)
+
+    def _spill_message(self, message, segment, future):
+        """
+        Give a spilled message a future that acks it on the spill and
+        resolves the caller's future once it is published or confirmed.
+        If it is nacked instead it is queued to be sent again.
+        """
+        sent = Future()
+
+        def on_done(done):
+            if done.exception() is None:
+                self._spill.ack(segment)
+                if future is not None:
+                    future.set_result(done.result())
+            else:
+                self._nacked.append((message, segment, future))
+        sent.add_done_callback(on_done)
+        return message + (sent,)
+
+    def _send_batch(self, batch):
+        """
+        Hand the batch to the ioloop and wait for it to be published.
+        If the connection is replaced before the ioloop runs the callback,
+        the batch is taken back and sent again after reconnecting.
+        """
+        self._batch_done.clear()
+        self._inflight = batch
+        self._connection.ioloop.add_callback(
+            lambda: self._publish_batch(batch))
+        while not self._batch_done.wait(_IDLE_TIMEOUT):
+            if self._connection.is_open:
+                continue
+            with self._inflight_lock:
+                if self._inflight is batch:
+                    self._inflight = None
+                    self._unsent = batch + self._unsent
+                    self._await_reconnect = True
+                    return
+
+    def _publish_batch(self, batch):
+        """
+        Publish a batch of messages on the ioloop thread. If there is an
+        exception the remaining messages are kept and the send channel is
+        recreated on the autoreconnected connection
+        """
+        with self._inflight_lock:
+            if self._inflight is not batch:
+                return
+            self._inflight = None
+        for i, message in enumerate(batch):
+            if self._confirm:
+                with self._window:
+                    self._delivery_tag += 1
+                    self._pending[self._delivery_tag] = message
+            try:
+                self._channel.basic_publish(
+                    exchange=message[0],
+                    routing_key=message[1],
+                    properties=message[2],
+                    body=message[3]
+                )
+            except pika.exceptions.ChannelWrongStateError:
+                self._logger.error(
+                    'Error sending message (ChannelWrongState), reconnecting'
+                )
+                if self._confirm:
+                    with self._window:
+                        self._pending.pop(self._delivery_tag, None)
+                self._unsent = batch[i:] + self._unsent
+                self._await_reconnect = True
+                break
+            if not self._confirm and message[4] is not None:
+                message[4].set_result(True)
+            self._sent += 1
+        self._batch_done.set()
+
+
+def _copy_future(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
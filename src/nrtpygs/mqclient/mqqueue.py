@@ -0,0 +1,240 @@
+from collections import OrderedDict, deque
+import queue
+import threading
+import time
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+class BoundedQueue():
+    """
+    Thread safe FIFO queue bounded by a message count (maxsize) and/or a
+    total size in bytes (maxbytes), 0 meaning no bound. A put that would
+    exceed the bound is handled by the policy:
+        - block: wait up to timeout seconds for room, then raise queue.Full
+        - drop_oldest: drop queued messages from the front to make room
+        - drop_newest: drop the message being put
+        - coalesce: replace the queued message with the same key in place,
+          falling back to drop_oldest if there is none
+
+    dropped and coalesced count the messages lost to the policy. If given,
+    on_displaced(item, replacement) is called for every dropped item, with
+    the item that replaced it when coalesced or None when dropped.
+    The get side mirrors queue.Queue. If given, the ready Condition is
+    notified after every put that adds an item (see LaneQueue).
+    """
+
+    def __init__(self, maxsize=0, maxbytes=0, policy=BLOCK, timeout=None,
+                 on_displaced=None, ready=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy {}'.format(policy))
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+        self.coalesced = 0
+        self._on_displaced = on_displaced
+        # Entries are [key, item, size] lists so coalescing can update them
+        self._entries = deque()
+        self._keys = {}
+        self._bytes = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._ready = ready
+
+    def qsize(self):
+        return len(self._entries)
+
+    def empty(self):
+        return not self._entries
+
+    def nbytes(self):
+        return self._bytes
+
+    def put(self, item, key=None, size=0, timeout=-1):
+        """
+        Put an item of size bytes on the queue. key identifies items that
+        may replace each other under the coalesce policy. timeout overrides
+        the queue's block timeout.
+        """
+        self.put_many([(item, key, size)], timeout)
+
+    def put_many(self, entries, timeout=-1):
+        """
+        Put a list of (item, key, size) entries on the queue in order,
+        taking the lock once. Under the block policy the timeout applies to
+        each entry, and entries before the one that timed out stay queued.
+        """
+        displaced = []
+        added = False
+        try:
+            with self._mutex:
+                for item, key, size in entries:
+                    added |= self._put(item, key, size, timeout, displaced)
+        finally:
+            if self._ready is not None and added:
+                with self._ready:
+                    self._ready.notify()
+            if self._on_displaced:
+                for old, replacement in displaced:
+                    self._on_displaced(old, replacement)
+
+    def _put(self, item, key, size, timeout, displaced):
+        """
+        Put one item with the mutex held, returning True if it was added
+        """
+        if self._full(size):
+            if self.policy == BLOCK:
+                self._wait_for_room(
+                    size, self.timeout if timeout == -1 else timeout)
+            elif self.policy == DROP_NEWEST:
+                self.dropped += 1
+                displaced.append((item, None))
+                return False
+            elif self.policy == COALESCE and key in self._keys:
+                entry = self._keys[key]
+                displaced.append((entry[1], item))
+                self._bytes += size - entry[2]
+                entry[1] = item
+                entry[2] = size
+                self.coalesced += 1
+                # A larger replacement can still overrun maxbytes
+                while self.maxbytes and self._bytes > self.maxbytes \
+                        and len(self._entries) > 1:
+                    displaced.append((self._pop(), None))
+                    self.dropped += 1
+                return False
+            else:
+                self._drop_oldest(size, displaced)
+        entry = [key, item, size]
+        self._entries.append(entry)
+        self._bytes += size
+        if self.policy == COALESCE:
+            self._keys[key] = entry
+        self._not_empty.notify()
+        return True
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                if not self._entries:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self._entries:
+                    self._not_empty.wait()
+            else:
+                end = time.monotonic() + timeout
+                while not self._entries:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            return self._pop()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _pop(self):
+        key, item, size = entry = self._entries.popleft()
+        self._bytes -= size
+        if self._keys.get(key) is entry:
+            del self._keys[key]
+        self._not_full.notify()
+        return item
+
+    def _full(self, size):
+        if self.maxsize and len(self._entries) >= self.maxsize:
+            return True
+        # A single oversized item is still let into an empty queue
+        return bool(self.maxbytes and self._entries
+                    and self._bytes + size > self.maxbytes)
+
+    def _wait_for_room(self, size, timeout):
+        end = None if timeout is None else time.monotonic() + timeout
+        while self._full(size):
+            remaining = None if end is None else end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Full
+            self._not_full.wait(remaining)
+
+    def _drop_oldest(self, size, displaced):
+        while self._entries and self._full(size):
+            displaced.append((self._pop(), None))
+            self.dropped += 1
+
+
+class LaneQueue():
+    """
+    A set of BoundedQueue lanes, each with its own bound and policy, read
+    as a single queue in strict lane order: get() always returns from the
+    first non-empty lane, so a backlog in a later lane never delays an
+    earlier one. lanes is a list of (name, maxsize, maxbytes, policy)
+    tuples, highest priority first; put() takes the lane name. timeout
+    and on_displaced apply to every lane as in BoundedQueue.
+    """
+
+    def __init__(self, lanes, timeout=None, on_displaced=None):
+        self._ready = threading.Condition()
+        self.lanes = OrderedDict(
+            (name, BoundedQueue(maxsize, maxbytes, policy, timeout,
+                                on_displaced, self._ready))
+            for name, maxsize, maxbytes, policy in lanes)
+        self._order = list(self.lanes.values())
+
+    @property
+    def dropped(self):
+        return sum(lane.dropped for lane in self._order)
+
+    @property
+    def coalesced(self):
+        return sum(lane.coalesced for lane in self._order)
+
+    def qsize(self):
+        return sum(lane.qsize() for lane in self._order)
+
+    def empty(self):
+        return all(lane.empty() for lane in self._order)
+
+    def nbytes(self):
+        return sum(lane.nbytes() for lane in self._order)
+
+    def put(self, item, key=None, size=0, timeout=-1, lane=None):
+        """
+        Put an item on the named lane, by default the last one
+        """
+        self._lane(lane).put(item, key, size, timeout)
+
+    def put_many(self, entries, timeout=-1, lane=None):
+        """
+        Put (item, key, size) entries on the named lane, by default the
+        last one
+        """
+        self._lane(lane).put_many(entries, timeout)
+
+    def _lane(self, lane):
+        return self._order[-1] if lane is None else self.lanes[lane]
+
+    def get(self, block=True, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            while True:
+                for lane in self._order:
+                    try:
+                        return lane.get_nowait()
+                    except queue.Empty:
+                        pass
+                if not block:
+                    raise queue.Empty
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._ready.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import threading
+
+# Routing keys whose matching handlers are remembered by each TopicRouter
+ROUTE_CACHE_SIZE = 1024
+
+
+class TopicRouter():
+    """
+    Dispatches messages from one consumer queue to handlers registered
+    against AMQP topic patterns, where * matches exactly one word and #
+    matches zero or more words. The router is itself a consumer callback,
+    and binding_keys lists the patterns to bind the queue with:
+
+        router = TopicRouter()
+        router.route('rcs.telemetry.alm.*', on_alarm)
+        router.route('#.temp', on_temperature)
+        MqConsume().consume('rmq.telemetry', router.binding_keys,
+                            'tla.router', router)
+
+    Every handler whose pattern matches the routing key is called with
+    (ch, method, props, body), in the order they were registered; default,
+    if given, is called when none match. Patterns are held in a trie of
+    words, so matching a key costs about the number of its words rather
+    than the number of patterns, and the handlers for recently seen keys
+    are cached.
+    """
+
+    def __init__(self, default=None, cache_size=ROUTE_CACHE_SIZE):
+        self._default = default
+        self._cache_size = cache_size
+        self._root = _Node()
+        self._patterns = OrderedDict()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._order = 0
+
+    @property
+    def binding_keys(self):
+        return list(self._patterns)
+
+    def route(self, pattern, handler):
+        """
+        Call handler for messages whose routing key matches pattern
+        """
+        with self._lock:
+            node = self._root
+            for word in pattern.split('.'):
+                node = node.children.setdefault(word, _Node())
+            self._order += 1
+            node.handlers.append((self._order, handler))
+            self._patterns.setdefault(pattern, 0)
+            self._patterns[pattern] += 1
+            self._cache.clear()
+
+    def unroute(self, pattern, handler):
+        """
+        Stop calling handler for pattern
+        """
+        with self._lock:
+            node = self._root
+            for word in pattern.split('.'):
+                node = node.children.get(word)
+                if node is None:
+                    return
+            before = len(node.handlers)
+            node.handlers = [entry for entry in node.handlers
+                             if entry[1] != handler]
+            removed = before - len(node.handlers)
+            if removed:
+                self._patterns[pattern] -= removed
+                if not self._patterns[pattern]:
+                    del self._patterns[pattern]
+            self._cache.clear()
+
+    def match(self, routing_key):
+        """
+        Return the handlers whose patterns match routing_key
+        """
+        with self._lock:
+            handlers = self._cache.get(routing_key)
+            if handlers is not None:
+                self._cache.move_to_end(routing_key)
+                return handlers
+            found = {}
+            self._root.match(routing_key.split('.'), 0, found)
+            handlers = tuple(found[order] for order in sorted(found))
+            self._cache[routing_key] = handlers
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+            return handlers
+
+    def __call__(self, ch, method, props, body):
+        handlers = self.match(method.routing_key)
+        if not handlers and self._default is not None:
+            handlers = (self._default,)
+        for handler in handlers:
+            handler(ch, method, props, body)
+
+
+class _Node():
+    """
+    A trie node: the children by word (including * and #) and the handlers
+    of patterns ending here as (registration order, handler)
+    """
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+    def match(self, words, i, found):
+        """
+        Add the handlers of patterns matching words[i:] to found, keyed by
+        registration order so each is only added once
+        """
+        if i == len(words):
+            for entry in self.handlers:
+                found[entry[0]] = entry[1]
+        else:
+            child = self.children.get(words[i])
+            if child is not None:
+                child.match(words, i + 1, found)
+            child = self.children.get('*')
+            if child is not None:
+                child.match(words, i + 1, found)
+        child = self.children.get('#')
+        if child is not None:
+            for j in range(i, len(words) + 1):
+                child.match(words, j, found)
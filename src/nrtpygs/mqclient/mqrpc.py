@@ -1,183 +1,522 @@
-from nrtpygs.mqclient.mqconnection import MqConnection
+from nrtpygs.mqclient.mqconnection import CONSUME, connection_manager
+from nrtpygs.mqclient.mqrpccache import ALL, RpcCache, args_key
+from nrtpygs.codec import decode, get_codec
 import nrtpygs.customlogger as log
+from collections import deque
+from concurrent import futures
+import asyncio
 import pika
-import json
-import time
+import os
+import queue
+import threading
+import uuid
+
+# Seconds MqRpcClient.call waits for a response before giving up
+RPC_TIMEOUT = float(os.getenv('RMQ_RPC_TIMEOUT', '30'))
+
+# Most argument keys whose responses a cacheable RPC method keeps
+RPC_CACHE_SIZE = int(os.getenv('RMQ_RPC_CACHE_SIZE', '1024'))
+
+# Worker threads running RPC functions in MqRpcServer, and the default
+# calls of one method that may run at once and wait to run
+RPC_WORKERS = int(os.getenv('RMQ_RPC_WORKERS', '8'))
+RPC_CONCURRENCY = int(os.getenv('RMQ_RPC_CONCURRENCY', '1'))
+RPC_QUEUE_DEPTH = int(os.getenv('RMQ_RPC_QUEUE_DEPTH', '100'))
 
 
 class MqRpcServer():
     """
-    Main RPC class for handling RPCs
+    Main RPC class for handling RPCs. Requests are decoded according to
+    their content_type and responses are encoded with codec (see
+    nrtpygs.codec, default json).
+
+    RPC functions run on a pool of worker threads rather than on the
+    ioloop thread, and each method runs at most concurrency calls at once
+    with up to queue_depth more waiting (see register()). A request for a
+    method with a full queue gets a busy response straight away. Responses
+    are published from the ioloop thread with the request's correlation_id.
+
+    A method registered with a ttl is cacheable: its encoded response is
+    kept for ttl seconds per argument key (by default the args as
+    canonical JSON) and served straight from the consume callback, with
+    at most cache_size keys kept, least recently used first out. Identical
+    requests arriving while a call is running share its response rather
+    than running it again. Error responses are never cached. invalidate()
+    drops cached responses.
     """
 
-    def __init__(self, source = 'rpc'):
+    def __init__(self, source = 'rpc', codec=None, workers=RPC_WORKERS):
         """
         Set up the connection and consume callbacks
         """
         self.rmqlog = log.get_logger()
-        self.rmqconnection = MqConnection(source)
+        self._codec = get_codec(codec)
+        self._executor = futures.ThreadPoolExecutor(
+            max(1, workers), thread_name_prefix='rpcserver')
+        # method name -> _MethodLimit
+        self._limits = {}
+        # method name -> RpcCache, for cacheable methods
+        self._caches = {}
+        self._limits_lock = threading.Lock()
+        self.rmqconnection = connection_manager.lease(source, CONSUME)
         self.connection = self.rmqconnection.connect()
-        self.channel = self.rmqconnection.get_channel()
+        try:
+            self.channel = self.rmqconnection.get_channel()
+        except TimeoutError:
+            self._executor.shutdown()
+            self.rmqconnection.close()
+            raise
         self._setup_consume()
 
     def disconnect(self):
+        self._executor.shutdown()
         self.rmqconnection.close()
 
+    def register(self, name, function, concurrency=RPC_CONCURRENCY,
+                 queue_depth=RPC_QUEUE_DEPTH, ttl=None,
+                 cache_size=RPC_CACHE_SIZE, cache_key=None):
+        """
+        Expose function as the RPC method name, running at most
+        concurrency calls of it at once with queue_depth more queued.
+        With a ttl its responses are cached, keyed by cache_key(args) if
+        given.
+        """
+        setattr(self, name, function)
+        with self._limits_lock:
+            self._limits[name] = _MethodLimit(concurrency, queue_depth)
+            if ttl is None:
+                self._caches.pop(name, None)
+            else:
+                self._caches[name] = RpcCache(
+                    ttl, cache_size, cache_key or args_key)
+
+    def invalidate(self, name, args=ALL):
+        """
+        Drop the cached responses of method name for args, or for all
+        arguments if args is not given
+        """
+        cache = self._caches.get(name)
+        if cache is None:
+            return
+        cache.invalidate(ALL if args is ALL else cache.key(args))
+
     def _rpc_handle_callback(self, ch, method, props, body):
         """
-        Handle RPC requests sent with a JSON type payload
+        Handle RPC requests sent with a JSON (or other codec) type payload
         TODO: This should be much more rigorous for safety
         i.e. checking user ids and privilidges
         """
         self.rmqlog.log(1, 'RPC callback triggered')
         try:
-            message = json.loads(body)
-        except json.JSONDecodeError:
-            self.rmqlog.log(3, 'Error with JSON decoding of message')
-            response = 'JSON decode error'
+            message = decode(body, props.content_type)
+        except ValueError:
+            self.rmqlog.log(3, 'Error with decoding of message')
+            self._reply(props, 'Decode error')
+            return
+        name = message['rpc']
+        self.rmqlog.log(1, 'RPC request received: {}'.format(name))
+        RPC = getattr(self, name, None)
+        if not callable(RPC):
+            self.rmqlog.log(1, 'No function called: {}'.format(name))
+            self._reply(props, 'No function called: ' + name)
+            return
+        with self._limits_lock:
+            limit = self._limits.get(name)
+            if limit is None:
+                limit = self._limits[name] = _MethodLimit(
+                    RPC_CONCURRENCY, RPC_QUEUE_DEPTH)
+        cache = self._caches.get(name)
+        key = None
+        if cache is not None:
+            key = cache.key(message['args'])
+            payload = cache.get(key)
+            if payload is not None:
+                self.rmqlog.log(1, 'Serving cached response for {}'.format(
+                    name))
+                self._publish(props, payload)
+                return
+            if cache.join(key, props):
+                return
+        call = (name, RPC, message['args'], props, cache, key)
+        try:
+            run_now = limit.admit(call)
+        except queue.Full:
+            self.rmqlog.log(2, 'RPC {} is busy, rejecting call'.format(name))
+            self._reply(props, 'Busy: ' + name)
             return
-        self.rmqlog.log(1, 'RPC request received: {}'.format(message['rpc']))
-        RPC = getattr(self, message['rpc'], None)
-        if callable(RPC):
-            self.rmqlog.log(1, 'Calling function: {}'.format(message['rpc']))
-            response = RPC(message['args'])
-        else:
-            self.rmqlog.log(1, 'No function called: {}'.format(message['rpc']))
-            response = 'No function called: ' + message['rpc']
+        if cache is not None:
+            cache.start(key)
+        if run_now:
+            self._submit(limit, call)
+
+    def _submit(self, limit, call):
+        future = self._executor.submit(self._run, *call)
+        future.add_done_callback(lambda _done: self._finished(limit))
+
+    def _finished(self, limit):
+        call = limit.finished()
+        if call is not None:
+            self._submit(limit, call)
+
+    def _run(self, name, RPC, args, props, cache, key):
+        """
+        Call an RPC function on a worker thread and send its response, to
+        any identical requests that arrived meanwhile too
+        """
+        self.rmqlog.log(1, 'Calling function: {}'.format(name))
+        failed = False
+        try:
+            response = RPC(args)
+        except Exception as e:
+            self.rmqlog.log(3, 'RPC {} failed: {}'.format(name, e))
+            response = 'Error in {}: {}'.format(name, e)
+            failed = True
         self.rmqlog.log(1, 'Response is: {}'.format(response))
-        self.rmqlog.log(1, 'Sending response: {}'.format(json.dumps(response)))
+        payload = self._codec.encode(response)
+        waiters = []
+        if cache is not None:
+            waiters = cache.finish(key, None if failed else payload)
+        for reply_props in [props] + waiters:
+            self._publish(reply_props, payload)
+
+    def _reply(self, props, response):
+        """
+        Publish a response to the caller's reply queue from the ioloop
+        """
+        self._publish(props, self._codec.encode(response))
 
+    def _publish(self, props, payload):
+        self.rmqlog.log(1, 'Sending response: {}'.format(payload))
+        properties = pika.BasicProperties(
+            type='rpc',
+            content_type=self._codec.content_type,
+            correlation_id=props.correlation_id,
+        )
         self.connection.ioloop.add_callback(
             lambda: self.channel.basic_publish(
                 exchange='rmq.direct',
                 routing_key=props.reply_to,
-                properties=pika.BasicProperties(
-                    type='rpc'
-                ),
-                body=json.dumps(response)
+                properties=properties,
+                body=payload
             )
         )
 
     def _setup_consume(self):
         """
-        Setup the queues for RPC
+        Setup the queues for RPC. Each step runs on the ioloop once the
+        broker has confirmed the one before.
         """
         self.rmqlog.log(1, 'Starting RPC consume')
-
         queue_name = '.rpcserver'
-        time.sleep(0.2)
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.queue_declare(
+        channel = self.channel
+
+        def on_bind_ok(_frame):
+            self.rmqlog.log(1, 'Starting RPC consume on ' + queue_name)
+            channel.basic_consume(
                 queue=queue_name,
-                durable=True,
+                on_message_callback=self._rpc_handle_callback,
+                auto_ack=True,
             )
-        )
 
-        self.rmqlog.log(1, 'Making bindings')
-        time.sleep(0.2)
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.queue_bind(
+        def on_declare_ok(_frame):
+            self.rmqlog.log(1, 'Making bindings')
+            channel.queue_bind(
                 exchange='rmq.direct',
                 queue=queue_name,
+                callback=on_bind_ok
             )
-        )
-        time.sleep(0.2)
-        self.rmqlog.log(1, 'Making bindings')
         self.connection.ioloop.add_callback(
-            lambda: self.channel.basic_consume(
+            lambda: channel.queue_declare(
                 queue=queue_name,
-                on_message_callback=self._rpc_handle_callback,
-                auto_ack=True,
+                durable=True,
+                callback=on_declare_ok
             )
         )
-        time.sleep(0.2)
+
+
+class _MethodLimit():
+    """
+    Concurrency limit and bounded backlog of calls for one RPC method
+    """
+
+    def __init__(self, concurrency, queue_depth):
+        self.concurrency = max(1, concurrency)
+        self.queue_depth = queue_depth
+        self.running = 0
+        self._backlog = deque()
+        self._lock = threading.Lock()
+
+    def admit(self, call):
+        """
+        Return True if the call can run now, otherwise queue it and return
+        False. Raises queue.Full if the backlog is full.
+        """
+        with self._lock:
+            if self.running < self.concurrency:
+                self.running += 1
+                return True
+            if len(self._backlog) >= self.queue_depth:
+                raise queue.Full
+            self._backlog.append(call)
+            return False
+
+    def finished(self):
+        """
+        Record a call as finished, returning the next queued call to run
+        in its place if there is one
+        """
+        with self._lock:
+            if self._backlog:
+                return self._backlog.popleft()
+            self.running -= 1
+            return None
 
 
 class MqRpcClient():
     """
-    Client Library for making RPC calls
+    Client Library for making RPC calls. Requests are encoded with codec
+    (see nrtpygs.codec, default json). call() returns the response text,
+    or with decode=True the response decoded according to its content_type.
+
+    Responses come back on one exclusive reply queue per client,
+    rpcclient.<uuid>, bound to rmq.direct and consumed on a channel of
+    its own. The channel and queue are set up on the ioloop by the first
+    call, and again by the next call or reconnect after the channel is
+    lost; requests wait on the ioloop until the queue is consumed, so no
+    call blocks its caller. Each request carries a
+    correlation_id that the server copies to its response, so any number
+    of calls from any threads may be in flight at once: call_async()
+    returns a concurrent.futures.Future and acall() is the asyncio
+    equivalent. Futures are resolved on the ioloop thread. call_many()
+    sends one call to many TLAs at once and gathers their responses.
     """
-    def __init__(self):
+    def __init__(self, codec=None, decode=False):
         """
         Set up the connection
         """
-        self.rmqconnection = MqConnection('rpcclient')
+        self.rmqlog = log.get_logger()
+        self._codec = get_codec(codec)
+        self._decode = decode
+        self.response_queue = 'rpcclient.' + uuid.uuid4().hex
+        # correlation_id -> (future, timeout handle) of calls in flight,
+        # and the requests waiting for the reply queue to be consumed.
+        # These and the reply channel are only touched on the ioloop thread.
+        self._pending = {}
+        self._waiting = []
+        self.channel = None
+        self._consuming = False
+        self.rmqconnection = connection_manager.lease('rpcclient')
         self.connection = self.rmqconnection.connect()
-        self.channel = self.rmqconnection.get_channel()
+        self.rmqconnection.add_on_open_callback(self._on_connection_open)
 
     def disconnect(self):
         self.rmqconnection.close()
 
-    def call(self, TLA, funcname, args=None):
+    def call(self, TLA, funcname, args=None, timeout=RPC_TIMEOUT):
         """
-        Send an RPC call and wait on responses
+        Send an RPC call and wait on responses. Raises TimeoutError if no
+        response arrives within timeout seconds. Cannot be called on the
+        client's own ioloop thread, e.g. from a call_async() callback, as
+        the response would never be handled.
         """
+        if self.rmqconnection.in_ioloop_thread():
+            raise RuntimeError(
+                'MqRpcClient.call() would block its own ioloop, use '
+                'call_async()')
+        future = self.call_async(TLA, funcname, args, timeout)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            raise TimeoutError(
+                'No response to RPC {} from {} after {}s'
+                .format(funcname, TLA, timeout))
 
-        body = {
-            'rpc': funcname,
-            'args': args,
+    def call_many(self, targets, funcname, args=None, timeout=RPC_TIMEOUT):
+        """
+        Send the same RPC call to every TLA in targets at once and gather
+        the responses until they are all in or timeout seconds have gone.
+        Returns a dict of TLA -> response for the targets that answered,
+        and a list of the targets that did not.
+        """
+        calls = {
+            TLA: self.call_async(TLA, funcname, args, timeout)
+            for TLA in targets
         }
+        futures.wait(calls.values(), timeout)
+        results = {}
+        timed_out = []
+        for TLA, future in calls.items():
+            if future.done() and future.exception() is None:
+                results[TLA] = future.result()
+            elif future.done() and \
+                    not isinstance(future.exception(), TimeoutError):
+                # Answered, but the response could not be decoded
+                results[TLA] = future.exception()
+            else:
+                timed_out.append(TLA)
+        return results, timed_out
 
-        self.rmqlog.log(1, 'Starting RPC Call')
-        self.rmqlog.log(1, 'Making response channel and queue')
-        response_queue = 'rpcclient' + '.' + 'rpcresponse'
+    async def acall(self, TLA, funcname, args=None, timeout=RPC_TIMEOUT):
+        """
+        call() for asyncio code, awaiting the response without blocking
+        the event loop
+        """
+        return await asyncio.wrap_future(
+            self.call_async(TLA, funcname, args, timeout))
 
-        self.rmqlog.log(1, 'Creating response queue {}'.format(response_queue))
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.queue_declare(
-                queue=response_queue, exclusive=True
-            )
+    def call_async(self, TLA, funcname, args=None, timeout=RPC_TIMEOUT):
+        """
+        Send an RPC call and return a Future for its response, which fails
+        with TimeoutError if no response arrives within timeout seconds
+        """
+        if self.rmqconnection.forked:
+            raise RuntimeError(
+                'MqRpcClient was created before the process forked and '
+                'cannot call from the child')
+        future = futures.Future()
+        correlation_id = uuid.uuid4().hex
+        routing_key = TLA + '.rpcserver'
+        body = self._codec.encode({
+            'rpc': funcname,
+            'args': args,
+        })
+        properties = pika.BasicProperties(
+            type='rpc',
+            reply_to=self.response_queue,
+            correlation_id=correlation_id,
+            content_type=self._codec.content_type,
         )
-        time.sleep(0.2)
+        self.rmqlog.log(1, 'Sending RPC request {} to {}'.format(
+            funcname, routing_key))
 
-        self.rmqlog.log(1, 'Making bindings')
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.queue_bind(
+        connection = self.rmqconnection.connection
+
+        def send():
+            expire = connection.ioloop.call_later(
+                timeout, lambda: self._expire(correlation_id, funcname, TLA,
+                                              timeout))
+            self._pending[correlation_id] = (future, expire)
+            self._waiting.append((routing_key, properties, body))
+            self._send_waiting()
+        if connection is None:
+            future.set_exception(ConnectionError(
+                'No connection to send RPC {} to {}'.format(funcname, TLA)))
+            return future
+        self.connection = connection
+        connection.ioloop.add_callback(send)
+        return future
+
+    def _send_waiting(self):
+        """
+        Publish the waiting requests once the reply queue is consumed,
+        setting it up first if needed. Runs on the ioloop thread.
+        """
+        if not self._waiting:
+            return
+        channel = self.channel
+        if channel is None or not channel.is_open or not self._consuming:
+            self._open_reply_channel()
+            return
+        waiting, self._waiting = self._waiting, []
+        for routing_key, properties, body in waiting:
+            if properties.correlation_id not in self._pending:
+                # Timed out while waiting
+                continue
+            channel.basic_publish(
                 exchange='rmq.direct',
-                queue=response_queue
+                routing_key=routing_key,
+                properties=properties,
+                body=body
             )
-        )
-        time.sleep(0.2)
 
-        self.rmqlog.log(1, 'Making callback setup for ' + response_queue)
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.basic_consume(
-                queue=response_queue,
-                on_message_callback=self.rpcResponse,
-                auto_ack=True
-            )
-        )
-        time.sleep(0.2)
+    def _open_reply_channel(self):
+        """
+        Open a channel for the reply queue, unless one is opening or the
+        connection is down (it is opened on reconnect)
+        """
+        if self.channel is not None and \
+                (self.channel.is_open or self.channel.is_opening):
+            return
+        connection = self.rmqconnection.connection
+        if connection is None or not connection.is_open:
+            return
+        self.connection = connection
+        self._consuming = False
+        self.channel = self.rmqconnection.create_channel(
+            on_open_callback=self._declare_reply_queue,
+            on_close_callback=self._on_reply_channel_closed)
 
-        routing_key = TLA + '.rpcserver'
-        self.rmqlog.log(1, 'Sending RPC request to {}'.format(routing_key))
+    def _on_connection_open(self, connection):
+        self._send_waiting()
 
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.basic_publish(
+    def _on_reply_channel_closed(self, channel, reason):
+        """
+        Forget the lost reply channel. Waiting requests go out once the
+        next call or reconnect sets up a new one.
+        """
+        self.rmqlog.log(2, 'Reply channel closed: {}'.format(reason))
+        if channel is self.channel:
+            self.channel = None
+            self._consuming = False
+
+    def _declare_reply_queue(self, channel):
+        self.rmqlog.log(1, 'Creating response queue {}'.format(
+            self.response_queue))
+
+        def on_consume_ok(_frame):
+            if channel is self.channel:
+                self._consuming = True
+                self._send_waiting()
+
+        def on_bind_ok(_frame):
+            channel.basic_consume(
+                queue=self.response_queue,
+                on_message_callback=self._on_response,
+                auto_ack=True,
+                callback=on_consume_ok
+            )
+
+        def on_declare_ok(_frame):
+            channel.queue_bind(
                 exchange='rmq.direct',
-                routing_key=routing_key,
-                properties=pika.BasicProperties(
-                    type='rpc',
-                    reply_to=response_queue,
-                ),
-                body=json.dumps(body)
+                queue=self.response_queue,
+                callback=on_bind_ok
             )
-        )
-        self.rmqlog.log(1, 'Awaiting RPC response')
-        self.response = None
-        while self.response is None:
-            pass
+        channel.queue_declare(
+            queue=self.response_queue, exclusive=True,
+            callback=on_declare_ok)
 
-        self.rmqlog.log(1, 'Received RPC response: ' + str(self.response))
-        self.rmqlog.log(1, 'Removing queue ' + response_queue)
-        self.connection.ioloop.add_callback(
-            lambda: self.channel.queue_delete(queue=response_queue)
-        )
-        return self.response.decode()
+    def _on_response(self, ch, method, props, body):
+        """
+        Resolve the future of the call the response belongs to
+        """
+        call = self._pending.pop(props.correlation_id, None)
+        if call is None:
+            self.rmqlog.log(2, 'Dropping RPC response for unknown call {}'
+                            .format(props.correlation_id))
+            return
+        future, expire = call
+        self.connection.ioloop.remove_timeout(expire)
+        if future.done():
+            # Cancelled by the caller
+            return
+        self.rmqlog.log(1, 'Received RPC response: ' + str(body))
+        try:
+            if self._decode:
+                response = decode(body, props.content_type)
+            else:
+                response = body.decode()
+        except ValueError as e:
+            future.set_exception(e)
+            return
+        future.set_result(response)
 
-    def rpcResponse(self, ch, method, props, body):
-        self.rmqlog.log(1, 'Received response')
-        self.response = body
+    def _expire(self, correlation_id, funcname, TLA, timeout):
+        call = self._pending.pop(correlation_id, None)
+        if call is not None and not call[0].done():
+            call[0].set_exception(TimeoutError(
+                'No response to RPC {} from {} after {}s'
+                .format(funcname, TLA, timeout)))
 
 
 # Create class intances
@@ -191,12 +530,39 @@ class MqRpcBase():
     This at least shows what is required
     """
     def __init__(self, rpc_function_list):
-        self.rpcRegister(rpc_function_list)
         self.rmqlog = log.get_logger()
+        self.rpcRegister(rpc_function_list)
 
-    def rpcRegister(self, rpc_function_list):
+    def rpcRegister(self, rpc_function_list, concurrency=RPC_CONCURRENCY,
+                    queue_depth=RPC_QUEUE_DEPTH):
+        """
+        Expose the named methods as RPC functions. concurrency and
+        queue_depth apply to each method, see MqRpcServer.register().
+        """
         self.rmqlog.log(2, 'Registering rpc functions')
         for function in rpc_function_list:
             self.rmqlog.log(1, 'Registering rpc function {}'.format(function))
             func = getattr(self, function, None)
-            setattr(rpcserver, func.__name__, func)
+            rpcserver.register(
+                func.__name__, func, concurrency, queue_depth)
+
+    def rpcCacheable(self, function, ttl, cache_size=RPC_CACHE_SIZE,
+                     cache_key=None, concurrency=RPC_CONCURRENCY,
+                     queue_depth=RPC_QUEUE_DEPTH):
+        """
+        Expose the named method as an RPC function whose responses are
+        cached for ttl seconds, see MqRpcServer.register()
+        """
+        self.rmqlog.log(1, 'Registering cacheable rpc function {}'.format(
+            function))
+        func = getattr(self, function, None)
+        rpcserver.register(
+            func.__name__, func, concurrency, queue_depth, ttl=ttl,
+            cache_size=cache_size, cache_key=cache_key)
+
+    def rpcInvalidate(self, function, args=ALL):
+        """
+        Drop cached responses of the named method, for args or for all
+        arguments
+        """
+        rpcserver.invalidate(function, args)
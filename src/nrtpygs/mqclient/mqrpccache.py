@@ -0,0 +1,86 @@
+from collections import OrderedDict
+import json
+import threading
+import time
+
+# Stands for every argument in MqRpcServer.invalidate()
+ALL = object()
+
+
+class RpcCache():
+    """
+    Cached encoded responses of one RPC method by argument key, least
+    recently used first out, and the requests waiting on calls in flight
+    """
+
+    def __init__(self, ttl, size, key):
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.key = key
+        # key -> (expiry time, payload)
+        self._entries = OrderedDict()
+        # key -> (generation when started, props of waiting requests)
+        self._inflight = {}
+        # Bumped by invalidate() so calls in flight do not cache old data
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached payload for key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def join(self, key, props):
+        """
+        Wait on the call in flight for key, returning False if there is
+        none
+        """
+        with self._lock:
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                return False
+            inflight[1].append(props)
+            return True
+
+    def start(self, key):
+        with self._lock:
+            self._inflight[key] = (self._generation, [])
+
+    def finish(self, key, payload):
+        """
+        Cache the payload of the call for key, unless it is None or the
+        cache was invalidated during the call, and return the waiting
+        requests' props
+        """
+        with self._lock:
+            generation, waiters = self._inflight.pop(key, (None, []))
+            if payload is not None and generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, payload)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            return waiters
+
+    def invalidate(self, key=ALL):
+        with self._lock:
+            self._generation += 1
+            if key is ALL:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+def args_key(args):
+    """
+    Default cache key: the args as canonical JSON
+    """
+    return json.dumps(args, sort_keys=True, default=repr)
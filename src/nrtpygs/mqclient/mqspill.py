@@ -0,0 +1,231 @@
+import nrtpygs.customlogger as log
+import mmap
+import os
+import struct
+import threading
+
+# Size of each spill segment file in bytes
+SPILL_SEGMENT_BYTES = int(os.getenv('RMQ_SPILL_SEGMENT_BYTES', '16777216'))
+
+# Record header: payload length, routing key length. A zero payload
+# length marks the end of the records in a segment.
+_HEADER = struct.Struct('>IH')
+_SUFFIX = '.seg'
+
+
+class SpillQueue():
+    """
+    Disk-backed FIFO of (routing_key, payload) records, used by MqProducer
+    to hold messages that do not fit in memory during a broker outage.
+
+    Records are appended to memory-mapped segment files of segment_bytes
+    in directory, rotating to a new segment when one is full. read()
+    returns records in order along with their segment number, and a
+    segment file is deleted once it has been read to the end and every
+    record read from it has been passed to ack(). Segments left by a
+    previous run are replayed first, so delivery is at least once.
+    """
+
+    def __init__(self, directory, segment_bytes=SPILL_SEGMENT_BYTES):
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._logger = log.get_logger()
+        os.makedirs(directory, exist_ok=True)
+        # Segment number -> [records read, records acked]
+        self._segments = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(_SUFFIX):
+                self._segments[int(name[:-len(_SUFFIX)])] = [0, 0]
+        self._unread = sum(self._count(s) for s in self._segments)
+        if self._unread:
+            self._logger.info('Replaying {} spilled messages from {}'
+                              .format(self._unread, directory))
+        # Segments numbered from here on were written by this process
+        self.first_segment = max(self._segments, default=-1) + 1
+        self._next_segment = self.first_segment
+        self._write_segment = None
+        self._write_map = None
+        self._write_offset = 0
+        self._read_segment = min(self._segments, default=None)
+        self._read_map = None
+        self._read_offset = 0
+
+    def empty(self):
+        return self._unread == 0
+
+    def __len__(self):
+        return self._unread
+
+    def settled(self):
+        """
+        Whether every record has been read and acked
+        """
+        with self._lock:
+            return not self._unread and all(
+                read == acked for read, acked in self._segments.values())
+
+    def write(self, routing_key, payload):
+        """
+        Append a record to the current segment, rotating if it is full
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        key = routing_key.encode()
+        size = _HEADER.size + len(key) + len(payload)
+        with self._lock:
+            # Leave room for the zero header that ends the segment
+            if self._write_map is None or \
+                    self._write_offset + size + _HEADER.size \
+                    > len(self._write_map):
+                self._rotate(size + _HEADER.size)
+            offset = self._write_offset
+            _HEADER.pack_into(self._write_map, offset, len(payload), len(key))
+            offset += _HEADER.size
+            self._write_map[offset:offset + len(key)] = key
+            offset += len(key)
+            self._write_map[offset:offset + len(payload)] = payload
+            self._write_offset = offset + len(payload)
+            self._unread += 1
+
+    def read(self):
+        """
+        Return the next (segment, routing_key, payload) record, or None if
+        all records have been read
+        """
+        with self._lock:
+            while self._unread:
+                record = self._read_record()
+                if record is None:
+                    if self._read_segment == self._write_segment:
+                        break
+                    self._finish_read_segment()
+                    continue
+                self._unread -= 1
+                self._segments[record[0]][0] += 1
+                # Finish a sealed segment straight away so it can be
+                # deleted as soon as its last record is acked
+                if self._read_segment != self._write_segment and \
+                        self._at_segment_end():
+                    self._finish_read_segment()
+                return record
+            return None
+
+    def ack(self, segment):
+        """
+        Mark a record read from segment as delivered, deleting the segment
+        once all of its records are delivered
+        """
+        with self._lock:
+            counts = self._segments.get(segment)
+            if counts is None:
+                return
+            counts[1] += 1
+            self._delete_if_done(segment)
+
+    def close(self):
+        with self._lock:
+            for segment_map in (self._write_map, self._read_map):
+                if segment_map is not None:
+                    segment_map.flush()
+                    segment_map.close()
+            self._write_map = self._read_map = None
+
+    def _path(self, segment):
+        return os.path.join(
+            self._directory, '{:020d}{}'.format(segment, _SUFFIX))
+
+    def _rotate(self, size):
+        if self._write_map is not None:
+            self._write_map.flush()
+            self._write_map.close()
+        self._write_segment = self._next_segment
+        self._next_segment += 1
+        with open(self._path(self._write_segment), 'w+b') as f:
+            f.truncate(max(self._segment_bytes, size))
+            self._write_map = mmap.mmap(f.fileno(), 0)
+        self._write_offset = 0
+        self._segments[self._write_segment] = [0, 0]
+        if self._read_segment is None:
+            self._read_segment = self._write_segment
+
+    def _count(self, segment):
+        """
+        Count the records in a segment written by a previous run
+        """
+        count = 0
+        with open(self._path(segment), 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, key_length = _HEADER.unpack_from(data, offset)
+            if length == 0:
+                break
+            offset += _HEADER.size + key_length + length
+            count += 1
+        return count
+
+    def _read_record(self):
+        """
+        Read the record at the read offset, or return None at the end of
+        the read segment
+        """
+        if self._read_segment is None:
+            return None
+        if self._read_map is None:
+            with open(self._path(self._read_segment), 'rb') as f:
+                self._read_map = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._read_offset = 0
+        offset = self._read_offset
+        if self._read_segment == self._write_segment and \
+                offset >= self._write_offset:
+            return None
+        if self._at_segment_end():
+            return None
+        length, key_length = _HEADER.unpack_from(self._read_map, offset)
+        offset += _HEADER.size
+        key = self._read_map[offset:offset + key_length].decode()
+        offset += key_length
+        payload = self._read_map[offset:offset + length]
+        self._read_offset = offset + length
+        return self._read_segment, key, payload
+
+    def _at_segment_end(self):
+        offset = self._read_offset
+        if offset + _HEADER.size > len(self._read_map):
+            return True
+        return _HEADER.unpack_from(self._read_map, offset)[0] == 0
+
+    def _finish_read_segment(self):
+        """
+        Move the reader on to the next segment once the write side has
+        moved past the current one
+        """
+        self._read_map.close()
+        self._read_map = None
+        finished = self._read_segment
+        self._read_segment = min(
+            (s for s in self._segments if s > finished), default=None)
+        self._delete_if_done(finished)
+
+    def _delete_if_done(self, segment):
+        read, acked = self._segments[segment]
+        if acked < read:
+            return
+        if segment == self._write_segment:
+            # The writer's segment can go once everything has been read
+            # and delivered; the next write starts a new segment
+            if self._unread:
+                return
+            self._write_map.close()
+            self._write_map = None
+            self._write_segment = None
+            if self._read_map is not None:
+                self._read_map.close()
+                self._read_map = None
+            self._read_segment = None
+        elif segment == self._read_segment:
+            return
+        del self._segments[segment]
+        os.remove(self._path(segment))
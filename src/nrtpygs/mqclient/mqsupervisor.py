@@ -0,0 +1,166 @@
+from nrtpygs.mqclient.mqconsumer import MqConsume
+import nrtpygs.customlogger as log
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+# Worker processes started by MqSupervisor, by default one per core
+SUPERVISOR_WORKERS = int(os.getenv('RMQ_SUPERVISOR_WORKERS',
+                                   str(os.cpu_count() or 1)))
+
+# Seconds before a crashed worker is restarted, and between throughput
+# reports in the log
+RESTART_DELAY = float(os.getenv('RMQ_SUPERVISOR_RESTART_DELAY', '1'))
+REPORT_INTERVAL = float(os.getenv('RMQ_SUPERVISOR_REPORT_INTERVAL', '60'))
+
+# Seconds a worker is given to finish after SIGTERM before it is killed
+SHUTDOWN_TIMEOUT = 10
+
+# Seconds between the supervisor's checks on its workers, and between a
+# worker's updates of its message count
+_POLL_INTERVAL = 0.5
+
+
+class MqSupervisor():
+    """
+    Runs a consumer in several forked worker processes so handlers that
+    are CPU bound are not limited to one core by the GIL. Each worker has
+    its own connection (see MqConnectionManager) and calls setup(consume)
+    with a fresh MqConsume, on which setup declares its consumers as
+    usual. Workers consuming the same queue share its messages as
+    competing consumers.
+
+    run() blocks until the supervisor gets SIGTERM or SIGINT, or stop() is
+    called, then passes SIGTERM on to the workers, which disconnect and
+    exit. A worker that dies is restarted after restart_delay seconds.
+    counts() returns the messages consumed by each worker slot, and the
+    total rate is logged every report_interval seconds.
+
+    Only the main thread can run() a supervisor, as it handles signals.
+
+    Workers are forked, so any publisher or RPC client the parent made
+    (such as the module level mqtelemetry.rmqtel or mqrpc.rpcclient) has
+    no connection or publisher thread in a worker and raises RuntimeError
+    when used there. Create the ones the handlers need inside setup.
+    """
+
+    def __init__(self, setup, workers=SUPERVISOR_WORKERS,
+                 restart_delay=RESTART_DELAY,
+                 report_interval=REPORT_INTERVAL):
+        self._setup = setup
+        self._workers = max(1, workers)
+        self._restart_delay = restart_delay
+        self._report_interval = report_interval
+        self._context = multiprocessing.get_context('fork')
+        self._counts = self._context.Array('Q', self._workers, lock=False)
+        self._procs = [None] * self._workers
+        self._restart_at = [None] * self._workers
+        self._stop = threading.Event()
+        self._logger = log.get_logger()
+
+    def counts(self):
+        return list(self._counts)
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        handlers = {
+            signum: signal.signal(signum, self._on_signal)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            for slot in range(self._workers):
+                self._start(slot)
+            self._supervise()
+        finally:
+            self._shutdown()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _on_signal(self, signum, frame):
+        self._logger.info('Supervisor got signal {}, stopping'.format(signum))
+        self._stop.set()
+
+    def _start(self, slot):
+        proc = self._context.Process(
+            target=_worker_main,
+            args=(self._setup, slot, self._counts),
+            name='mqworker-{}'.format(slot))
+        proc.start()
+        self._procs[slot] = proc
+        self._restart_at[slot] = None
+        self._logger.info('Started worker {} (pid {})'.format(slot, proc.pid))
+
+    def _supervise(self):
+        last_report = time.monotonic()
+        last_total = sum(self._counts)
+        while not self._stop.wait(_POLL_INTERVAL):
+            now = time.monotonic()
+            for slot, proc in enumerate(self._procs):
+                if proc.is_alive():
+                    continue
+                if self._restart_at[slot] is None:
+                    self._logger.error(
+                        'Worker {} (pid {}) exited with code {}'
+                        .format(slot, proc.pid, proc.exitcode))
+                    self._restart_at[slot] = now + self._restart_delay
+                elif now >= self._restart_at[slot]:
+                    self._start(slot)
+            if now - last_report >= self._report_interval:
+                total = sum(self._counts)
+                self._logger.info(
+                    'Workers consumed {:.0f} msg/s, {} messages per worker'
+                    .format((total - last_total) / (now - last_report),
+                            self.counts()))
+                last_report = now
+                last_total = total
+
+    def _shutdown(self):
+        """
+        SIGTERM the workers and wait for them, killing any that overrun
+        """
+        procs = [proc for proc in self._procs
+                 if proc is not None and proc.is_alive()]
+        for proc in procs:
+            proc.terminate()
+        end = time.monotonic() + SHUTDOWN_TIMEOUT
+        for proc in procs:
+            proc.join(max(0, end - time.monotonic()))
+            if proc.is_alive():
+                self._logger.warning(
+                    'Worker pid {} did not stop, killing'.format(proc.pid))
+                proc.kill()
+                proc.join()
+
+
+class _CountingConsume(MqConsume):
+    """
+    MqConsume whose consumers count the messages they receive. Counting
+    is done on the ioloop thread, so callbacks are passed on unwrapped
+    and may still be run by process workers.
+    """
+    _count_received = True
+
+    @property
+    def received(self):
+        return sum(consumer.received for consumer in self._consumers)
+
+
+def _worker_main(setup, slot, counts):
+    """
+    Entry point of a worker process: consume until SIGTERM
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # Ctrl-C reaches the whole process group; the supervisor handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    base = counts[slot]
+    consume = _CountingConsume()
+    setup(consume)
+    while not stop.wait(_POLL_INTERVAL):
+        counts[slot] = base + consume.received
+    consume.disconnect()
+    counts[slot] = base + consume.received
@@ -1,40 +1,162 @@
 import datetime
 import pika
-from nrtpygs.mqclient.mqconnection import MqConnection
-import nrtpygs.customlogger as log
-from queue import Queue
-import json
-import time
+from nrtpygs.mqclient.mqpublisher import (
+    MqPublisher, PUBLISH_BATCH_SIZE, PUBLISH_BATCH_BYTES,
+    PUBLISH_QUEUE_SIZE, PUBLISH_QUEUE_BYTES, PUBLISH_QUEUE_TIMEOUT
+)
+from nrtpygs.mqclient.mqqueue import LaneQueue
+from nrtpygs.codec import get_codec
+import numbers
+import os
 import threading
+import time
+
+# Packed mode: a frame is sent when it holds this many samples, this many
+# (approximate) bytes, or its first sample is this many seconds old
+PACK_COUNT = int(os.getenv('RMQ_TEL_PACK_COUNT', '1000'))
+PACK_BYTES = int(os.getenv('RMQ_TEL_PACK_BYTES', '65536'))
+PACK_INTERVAL = float(os.getenv('RMQ_TEL_PACK_INTERVAL', '0.1'))
+
+# Routing key of packed telemetry frames
+FRAME_ROUTING_KEY = 'rcs.telemetry.frame'
 
+# Lanes in drain order, with the AMQP priority of their messages. Queues
+# consuming telemetry should be declared with x-max-priority of 3.
+LANE_PRIORITIES = (('alm', 3), ('evn', 2), ('tel', 1))
 
-class MqTelemetry():
+# Capacity of the alarm and event lanes in messages. Unlike tel samples
+# these are never dropped: alm() and evn() block when their lane is full.
+ALARM_QUEUE_SIZE = int(os.getenv('RMQ_TEL_ALARM_QUEUE_SIZE', '10000'))
+EVENT_QUEUE_SIZE = int(os.getenv('RMQ_TEL_EVENT_QUEUE_SIZE', '10000'))
+
+
+class MqTelemetry(MqPublisher):
+    """
+    Publish telemetry, alarms and events to the rmq.telemetry exchange.
+    Messages are queued and published in batches, see MqPublisher, and
+    serialised with codec (see nrtpygs.codec, default json).
 
-    def __init__(self):
-        self._sent = 0
-        self._sending_message = False
-        self._stopping = False
-        self._await_reconnect = False
-        self._logger = log.get_logger()
-        self._logger.debug('Initiating class')
-        self._rmqconnection = MqConnection('rmqtelemetry')
-        self._connection = self._rmqconnection.connect()
-        self._channel = self._rmqconnection.get_channel()
-        self._telq = Queue(maxsize=0)
+    The queue holds at most queue_size messages / queue_bytes bytes. When
+    it is full the oldest samples are dropped by default; queue_policy
+    selects another behaviour (see mqqueue.BoundedQueue), e.g. coalesce
+    to keep only the latest queued sample of each datum.
 
-        # Set up publish message thread.
-        self._telThread = threading.Thread(
-            target=self._publish_message_loop,
-            args=())
-        self._telThread.start()
+    set_deadband() makes tel() drop samples of a datum that have not
+    changed by more than a threshold since the last sample sent, with an
+    optional heartbeat so a steady value is still sent every so often.
+    suppressed counts the samples dropped this way.
+
+    With packed=True, tel() samples are gathered into frames published on
+    rcs.telemetry.frame instead of one message per sample. A frame holds
+    the samples in columns: {'type': 'frame', 'timestamp': ..., 'names':
+    [...], 'values': [...], 'timestamps': [unix seconds...]}. It is sent
+    once it holds pack_count samples or roughly pack_bytes, or pack_interval
+    seconds after its first sample. Use mqconsumer.unpack_frame() to get
+    the samples back. Alarms and events are never packed. Frames all share
+    one routing key, so the coalesce policy cannot be used with packed.
+
+    Alarms, events and tel samples are queued in separate lanes and
+    published in that order of precedence, each with its own AMQP priority
+    (see LANE_PRIORITIES), so a telemetry backlog does not hold up alarms.
+    queue_size, queue_bytes and queue_policy bound the tel lane; the alarm
+    and event lanes hold alarm_queue_size and event_queue_size messages,
+    and alm() and evn() wait up to queue_timeout seconds for room in them
+    before raising queue.Full.
+    """
+
+    def __init__(self, batch_size=PUBLISH_BATCH_SIZE,
+                 batch_bytes=PUBLISH_BATCH_BYTES,
+                 queue_size=PUBLISH_QUEUE_SIZE,
+                 queue_bytes=PUBLISH_QUEUE_BYTES,
+                 queue_policy='drop_oldest',
+                 queue_timeout=PUBLISH_QUEUE_TIMEOUT,
+                 codec=None, packed=False, pack_count=PACK_COUNT,
+                 pack_bytes=PACK_BYTES, pack_interval=PACK_INTERVAL,
+                 alarm_queue_size=ALARM_QUEUE_SIZE,
+                 event_queue_size=EVENT_QUEUE_SIZE):
+        if packed and queue_policy == 'coalesce':
+            # Coalescing would replace whole frames, not single samples
+            raise ValueError('Packed telemetry cannot use the coalesce '
+                             'policy')
+        self._codec = get_codec(codec)
+        self._lane_properties = {}
+        for lane, priority in LANE_PRIORITIES:
+            properties = pika.BasicProperties(
+                content_type=self._codec.content_type,
+                delivery_mode=2,
+            )
+            properties.priority = priority
+            self._lane_properties[lane] = properties
+        self._lane_sizes = {'alm': alarm_queue_size, 'evn': event_queue_size}
+        super().__init__('rmqtelemetry', 'rmq.telemetry',
+                         self._lane_properties['tel'],
+                         batch_size, batch_bytes,
+                         queue_size=queue_size, queue_bytes=queue_bytes,
+                         queue_policy=queue_policy,
+                         queue_timeout=queue_timeout)
+        self._telq = self._queue
+        # datum -> _Deadband holding its thresholds and last sent sample
+        self._deadbands = {}
+        self.suppressed = 0
+        self._packed = packed
+        if packed:
+            self._pack_count = pack_count
+            self._pack_bytes = pack_bytes
+            self._pack_interval = pack_interval
+            self._pack_lock = threading.Condition()
+            self._new_frame()
+            self._packThread = threading.Thread(
+                target=self._pack_loop,
+                args=())
+            self._packThread.start()
 
     def create_channel(self):
         self._channel = self._rmqconnection.create_channel()
 
+    def _make_queue(self, queue_size, queue_bytes, queue_policy,
+                    queue_timeout):
+        lanes = [
+            (lane, self._lane_sizes[lane], 0, 'block')
+            if lane in self._lane_sizes else
+            (lane, queue_size, queue_bytes, queue_policy)
+            for lane, _ in LANE_PRIORITIES
+        ]
+        return LaneQueue(lanes, queue_timeout, self._on_displaced)
+
+    def set_deadband(self, datum, absolute=None, relative=None,
+                     heartbeat=None):
+        """
+        Only send a sample of datum when it differs from the last one sent
+        by more than absolute, or by more than relative times the last
+        value. With neither threshold any change is sent; non-numeric
+        values are always compared for change. heartbeat is the longest
+        time in seconds to go without sending a sample.
+        """
+        self._deadbands[datum] = _Deadband(absolute, relative, heartbeat)
+
+    def clear_deadband(self, datum):
+        """
+        Send every sample of datum again
+        """
+        self._deadbands.pop(datum, None)
+
+    def _suppress(self, datum, value):
+        band = self._deadbands.get(datum)
+        if band is not None and band.suppress(value, time.monotonic()):
+            self.suppressed += 1
+            return True
+        return False
+
     def tel(self, datum, value):
         """
-        Add telemetry message to python queue
+        Add telemetry message to python queue, unless a deadband set for
+        the datum suppresses it
         """
+        if self._deadbands and self._suppress(datum, value):
+            return
+        if self._packed:
+            self._pack_many([datum], [value], None)
+            return
         time = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
         body = {
             'type': 'tel',
@@ -43,7 +165,52 @@ class MqTelemetry():
             'value': value,
         }
 
-        self._telq.put(body)
+        self._queue_body(body)
+
+    def tel_many(self, names, values, timestamps=None):
+        """
+        Add a telemetry message for each name and value pair to the python
+        queue in one go. names, values and the optional timestamps (unix
+        seconds) may be sequences or NumPy arrays of the same length.
+        Without timestamps every sample is stamped with the current time.
+        Deadbands apply to each sample as in tel().
+        """
+        names = _to_list(names)
+        values = _to_list(values)
+        if timestamps is not None:
+            timestamps = _to_list(timestamps)
+        if len(values) != len(names) or \
+                (timestamps is not None and len(timestamps) != len(names)):
+            raise ValueError('names, values and timestamps differ in length')
+        if self._deadbands:
+            keep = [i for i, (datum, value) in enumerate(zip(names, values))
+                    if not self._suppress(datum, value)]
+            names = [names[i] for i in keep]
+            values = [values[i] for i in keep]
+            if timestamps is not None:
+                timestamps = [timestamps[i] for i in keep]
+        if self._packed:
+            self._pack_many(names, values, timestamps)
+            return
+        if timestamps is None:
+            stamp = datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3]
+            stamps = [stamp] * len(names)
+        else:
+            stamps = [datetime.datetime.utcfromtimestamp(t).strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3] for t in timestamps]
+        encode = self._codec.encode
+        messages = [
+            ('rcs.telemetry.tel.' + datum, encode({
+                'type': 'tel',
+                'timestamp': stamp,
+                'name': datum,
+                'value': value,
+            }))
+            for datum, value, stamp in zip(names, values, stamps)
+        ]
+        self._enqueue_many(
+            messages, properties=self._lane_properties['tel'], lane='tel')
 
     def alm(self, name, state):
         """
@@ -57,7 +224,7 @@ class MqTelemetry():
             'value': state,
         }
 
-        self._telq.put(body)
+        self._queue_body(body)
 
     def evn(self, name):
         """
@@ -70,94 +237,138 @@ class MqTelemetry():
             'name': name,
         }
 
-        self._telq.put(body)
+        self._queue_body(body)
 
     def disconnect(self):
-        self._logger.info('Disconnecting Telemetry Connection')
-        self._stopping = True
-        # Wait for all messages to be sent from queue
-
-        while not self._telq.empty():
-            time.sleep(0.01)
-            pass
-        # Allow extra time for remaining messages to purge
-        time.sleep(0.5)
-        self._rmqconnection.close()
-        self._telThread.join()
-
-    def _await_new_channel(self):
-        """
-        Recreate the channel if there is a publish error
-        """
-        self._logger.info('Trying to recreate the channel')
-        try:
-            self._channel.close()
-        except Exception as e:
-            self._logger.error('Received Exception on channel close: {}'.format(e))
-        # Wait until Connection reopens if it was a channel issue;
-        self._logger.debug('Waiting on connection to reopen')
-
-        while not self._connection.is_open:
-            time.sleep(0.1)
-            self._connection = self._rmqconnection.get_connection()
-
-        self._logger.debug('Connection is open again, recreating channel')
-        self._channel = self._rmqconnection.create_channel()
+        if self._packed:
+            with self._pack_lock:
+                self._packed = False
+                self._send_frame()
+                self._pack_lock.notify()
+            self._packThread.join()
+        super().disconnect()
 
-    def _publish_message_loop(self):
+    def _new_frame(self):
+        self._names = []
+        self._values = []
+        self._timestamps = []
+        self._frame_bytes = 0
+        self._frame_start = None
+
+    def _pack_many(self, names, values, timestamps):
         """
-        Single thread function to read logq and publish log messages
+        Add samples to the current frame, sending frames as they fill
         """
-        self._logger.debug('Starting publish message loop')
-        while True:
-            # Stop the loop consuming all resource
-            # max rate 10kHz
-            time.sleep(0.0001)
-
-            if self._await_reconnect:
-                self._await_new_channel()
+        self._check_fork()
+        if timestamps is None:
+            timestamps = [time.time()] * len(names)
+        with self._pack_lock:
+            for datum, value, stamp in zip(names, values, timestamps):
+                if self._frame_start is None:
+                    self._frame_start = time.monotonic()
+                    self._pack_lock.notify()
+                self._names.append(datum)
+                self._values.append(value)
+                self._timestamps.append(stamp)
+                # Rough size of the sample once encoded
+                self._frame_bytes += len(datum) + 32
+                if len(self._names) >= self._pack_count or \
+                        self._frame_bytes >= self._pack_bytes:
+                    self._send_frame()
 
-            if not self._telq.empty() and not self._sending_message:
-                self._sending_message = True
-                self._connection.ioloop.add_callback(self._publish_message)
-                self._sent += 1
-                if self._sent % 1000 == 0:
-                    self._logger.debug(
-                        'Published {} telemetry messages. Queuesize is {}'
-                        .format(self._sent, self._telq.qsize())
-                    )
-
-            if self._telq.empty() and self._stopping:
-                break
+    def _pack_loop(self):
+        """
+        Send frames that are pack_interval old without filling up
+        """
+        with self._pack_lock:
+            while self._packed:
+                if self._frame_start is None:
+                    self._pack_lock.wait()
+                    continue
+                remaining = self._frame_start + self._pack_interval \
+                    - time.monotonic()
+                if remaining > 0:
+                    self._pack_lock.wait(remaining)
+                else:
+                    self._send_frame()
 
-    def _publish_message(self):
+    def _send_frame(self):
         """
-        Publish message in a loop until mit is sent. If there is an exception
-        then recreate the send channel on the autoreconnected connection
+        Queue the current frame, if it has samples, and start a new one.
+        Called with _pack_lock held.
         """
-        body = self._telq.get(block=True, timeout=None)
+        if not self._names:
+            return
+        body = {
+            'type': 'frame',
+            'timestamp': datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3],
+            'names': self._names,
+            'values': self._values,
+            'timestamps': self._timestamps,
+        }
+        self._new_frame()
+        self._enqueue(FRAME_ROUTING_KEY, self._codec.encode(body),
+                      properties=self._lane_properties['tel'], lane='tel')
+
+    def _queue_body(self, body):
         routing_key = 'rcs.telemetry.' \
                       + body['type'] + '.' + body['name']
-        priority = 1
-        properties = pika.BasicProperties(
-            content_type='json',
-            delivery_mode=2,
-        )
-        properties.priority = priority
-
-        try:
-            self._channel.basic_publish(
-                exchange='rmq.telemetry',
-                routing_key=routing_key,
-                properties=properties,
-                body=json.dumps(body)
-            )
-        except pika.exceptions.ChannelWrongStateError:
-            self._logger.error(
-                'Error sending message (ChannelWrongState), reconnecting.'
-            )
-            self._await_reconnect = True
-        self._sending_message = False
+        lane = body['type']
+        self._enqueue(routing_key, self._codec.encode(body),
+                      properties=self._lane_properties[lane], lane=lane)
+
+
+class _Deadband():
+    """
+    Thresholds and last sent sample for a datum with a deadband
+    """
+    __slots__ = ('absolute', 'relative', 'heartbeat', 'value', 'sent')
+
+    def __init__(self, absolute, relative, heartbeat):
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat
+        self.value = None
+        self.sent = None
+
+    def suppress(self, value, now):
+        """
+        Return True if the sample should not be sent, otherwise record it
+        as the last sent sample
+        """
+        if self.sent is not None and \
+                (self.heartbeat is None or now - self.sent < self.heartbeat) \
+                and not self._changed(value):
+            return True
+        self.value = value
+        self.sent = now
+        return False
+
+    def _changed(self, value):
+        last = self.value
+        if not _is_number(value) or not _is_number(last) or \
+                (self.absolute is None and self.relative is None):
+            return value != last
+        change = abs(value - last)
+        if self.absolute is not None and change > self.absolute:
+            return True
+        return self.relative is not None and \
+            change > self.relative * abs(last)
+
+
+def _to_list(values):
+    """
+    Turn a sequence or NumPy array into a list of plain Python values,
+    which the codecs can serialise
+    """
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return list(values)
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
 
 
 # Set up telemetry object
@@ -172,12 +383,15 @@ def main():
     delay_ms = 0
     print('Sending {} telemetry mesages with {}ms delay'
           .format(str(x), str(delay_ms)))
+    start = time.monotonic()
     for i in range(1, x+1):
         rmqtel.tel('temp', 122.3)
         time.sleep(delay_ms / 1000)
     print('Sent {} messages'.format(str(x)))
-    time.sleep(1)
     rmqtel.disconnect()
+    elapsed = time.monotonic() - start
+    print('Published {} messages in {:.3f}s ({:.0f} msg/s)'
+          .format(x, elapsed, x / elapsed))
 
 
 if __name__ == '__main__':
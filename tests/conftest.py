@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Test the package from the source tree
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src'))
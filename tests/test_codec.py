@@ -0,0 +1,49 @@
+import math
+
+import pytest
+
+from nrtpygs.codec import CODECS, decode, get_codec
+
+
+def test_unknown_codec_falls_back_to_json():
+    assert get_codec('nope').name == 'json'
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_round_trip(name):
+    codec = get_codec(name)
+    body = {'value': 1.5, 'names': ['a', 'b'], 'ok': True}
+    assert decode(codec.encode(body), codec.content_type) == body
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_format_is_sniffed_without_content_type(name):
+    codec = get_codec(name)
+    body = {'value': 1}
+    assert decode(codec.encode(body)) == body
+
+
+def test_json_scalars_are_sniffed_as_json():
+    assert decode('"hello"') == 'hello'
+    assert decode(b'[1, 2]') == [1, 2]
+    assert decode('-1') == -1
+
+
+def test_json_nan_and_infinity_are_decoded():
+    data = get_codec('json').encode(
+        {'value': float('nan'), 'max': float('inf')})
+    for content_type in ('json', None):
+        body = decode(data, content_type)
+        assert math.isnan(body['value'])
+        assert body['max'] == float('inf')
+    assert math.isnan(decode('NaN'))
+
+
+@pytest.mark.skipif('orjson' not in CODECS, reason='orjson not installed')
+def test_orjson_accepts_non_str_keys():
+    assert decode(get_codec('orjson').encode({1: 'a'})) == {'1': 'a'}
+
+
+def test_data_in_neither_format_raises_value_error():
+    with pytest.raises(ValueError):
+        decode(b'hello')
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+from nrtpygs.mqclient.mqdispatch import KeyedDispatcher
+
+
+def test_calls_with_the_same_key_run_in_order():
+    dispatcher = KeyedDispatcher(ThreadPoolExecutor(8))
+    seen = {}
+    lock = threading.Lock()
+
+    def call(key, i):
+        time.sleep(random.random() * 0.002)
+        with lock:
+            seen.setdefault(key, []).append(i)
+
+    for i in range(200):
+        key = i % 4
+        dispatcher.submit(key, call, (key, i), lambda future: None)
+    dispatcher.shutdown()
+    assert sum(len(calls) for calls in seen.values()) == 200
+    for calls in seen.values():
+        assert calls == sorted(calls)
+
+
+def test_calls_with_different_keys_run_concurrently():
+    dispatcher = KeyedDispatcher(ThreadPoolExecutor(2))
+    barrier = threading.Barrier(2, timeout=5)
+    done = []
+    dispatcher.submit('a', barrier.wait, (), done.append)
+    dispatcher.submit('b', barrier.wait, (), done.append)
+    dispatcher.shutdown()
+    assert [future.exception() for future in done] == [None, None]
+
+
+def test_on_done_gets_failures_and_later_calls_still_run():
+    dispatcher = KeyedDispatcher(ThreadPoolExecutor(2))
+    results = []
+
+    def fail():
+        raise RuntimeError('boom')
+
+    dispatcher.submit('k', fail, (), results.append)
+    dispatcher.submit('k', lambda: 'ok', (), results.append)
+    dispatcher.shutdown()
+    assert isinstance(results[0].exception(), RuntimeError)
+    assert results[1].result() == 'ok'
+
+
+def test_shutdown_waits_for_backlogged_calls():
+    dispatcher = KeyedDispatcher(ThreadPoolExecutor(1))
+    calls = []
+    for i in range(20):
+        dispatcher.submit('k', calls.append, (i,), lambda future: None)
+    dispatcher.shutdown()
+    assert calls == list(range(20))
@@ -0,0 +1,115 @@
+import queue
+
+import pytest
+
+from nrtpygs.mqclient.mqqueue import BoundedQueue, LaneQueue
+
+
+def _drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait())
+    return items
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        BoundedQueue(policy='nope')
+
+
+def test_block_raises_full_after_timeout():
+    q = BoundedQueue(maxsize=2, timeout=0.05)
+    q.put(1)
+    q.put(2)
+    with pytest.raises(queue.Full):
+        q.put(3)
+    assert _drain(q) == [1, 2]
+
+
+def test_drop_oldest_makes_room_and_reports_displaced():
+    displaced = []
+    q = BoundedQueue(maxsize=2, policy='drop_oldest',
+                     on_displaced=lambda old, new: displaced.append(
+                         (old, new)))
+    for i in range(4):
+        q.put(i)
+    assert _drain(q) == [2, 3]
+    assert q.dropped == 2
+    assert displaced == [(0, None), (1, None)]
+
+
+def test_drop_newest_drops_the_put_item():
+    q = BoundedQueue(maxsize=2, policy='drop_newest')
+    for i in range(4):
+        q.put(i)
+    assert _drain(q) == [0, 1]
+    assert q.dropped == 2
+
+
+def test_coalesce_replaces_in_place():
+    displaced = []
+    q = BoundedQueue(maxsize=2, policy='coalesce',
+                     on_displaced=lambda old, new: displaced.append(
+                         (old, new)))
+    q.put('a1', key='a')
+    q.put('b1', key='b')
+    q.put('a2', key='a')
+    assert _drain(q) == ['a2', 'b1']
+    assert q.coalesced == 1
+    assert displaced == [('a1', 'a2')]
+
+
+def test_coalesce_falls_back_to_drop_oldest_for_new_keys():
+    q = BoundedQueue(maxsize=2, policy='coalesce')
+    q.put('a1', key='a')
+    q.put('b1', key='b')
+    q.put('c1', key='c')
+    assert _drain(q) == ['b1', 'c1']
+    assert q.dropped == 1
+
+
+def test_maxbytes_bounds_the_queue():
+    q = BoundedQueue(maxbytes=10, policy='drop_oldest')
+    q.put('a', size=6)
+    q.put('b', size=6)
+    assert q.nbytes() == 6
+    assert _drain(q) == ['b']
+
+
+def test_oversized_item_is_let_into_an_empty_queue():
+    q = BoundedQueue(maxbytes=10, timeout=0)
+    q.put('big', size=100)
+    assert _drain(q) == ['big']
+
+
+def test_put_many_applies_the_policy_per_item():
+    q = BoundedQueue(maxsize=3, policy='drop_oldest')
+    q.put_many([(i, None, 0) for i in range(5)])
+    assert _drain(q) == [2, 3, 4]
+
+
+def test_get_times_out_on_an_empty_queue():
+    with pytest.raises(queue.Empty):
+        BoundedQueue().get(timeout=0.01)
+
+
+def test_lanes_are_read_in_priority_order():
+    q = LaneQueue([('high', 0, 0, 'block'), ('low', 0, 0, 'block')])
+    q.put('l1', lane='low')
+    q.put('h1', lane='high')
+    q.put('l2')
+    q.put('h2', lane='high')
+    assert q.qsize() == 4
+    assert _drain(q) == ['h1', 'h2', 'l1', 'l2']
+
+
+def test_lanes_keep_their_own_bounds():
+    q = LaneQueue([('high', 1, 0, 'block'), ('low', 2, 0, 'drop_oldest')],
+                  timeout=0.01)
+    q.put('h1', lane='high')
+    with pytest.raises(queue.Full):
+        q.put('h2', lane='high')
+    for i in range(3):
+        q.put(i, lane='low')
+    assert q.dropped == 1
+    assert _drain(q) == ['h1', 1, 2]
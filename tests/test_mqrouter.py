@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+from nrtpygs.mqclient.mqrouter import TopicRouter
+
+
+def _handler(name, calls):
+    def handler(ch, method, props, body):
+        calls.append(name)
+    return handler
+
+
+def _names(router, routing_key, handlers):
+    return [handlers[h] for h in router.match(routing_key)]
+
+
+def test_star_matches_exactly_one_word():
+    router = TopicRouter()
+    handler = object()
+    router.route('a.*.c', handler)
+    assert router.match('a.b.c') == (handler,)
+    assert router.match('a.c') == ()
+    assert router.match('a.b.b.c') == ()
+
+
+def test_hash_matches_zero_or_more_words():
+    router = TopicRouter()
+    handler = object()
+    router.route('a.#', handler)
+    router.route('#.temp', handler)
+    assert router.match('a') == (handler,)
+    assert router.match('a.b.c') == (handler,)
+    assert router.match('x.y.temp') == (handler,)
+    assert router.match('temp') == (handler,)
+    assert router.match('b.c') == ()
+
+
+def test_handlers_are_called_once_in_registration_order():
+    router = TopicRouter()
+    handlers = {}
+    for pattern in ('#', 'a.b', 'a.*', '*.b'):
+        handler = object()
+        handlers[handler] = pattern
+        router.route(pattern, handler)
+    assert _names(router, 'a.b', handlers) == ['#', 'a.b', 'a.*', '*.b']
+
+
+def test_hash_in_the_middle():
+    router = TopicRouter()
+    handler = object()
+    router.route('a.#.z', handler)
+    assert router.match('a.z') == (handler,)
+    assert router.match('a.b.c.z') == (handler,)
+    assert router.match('a.b.c') == ()
+
+
+def test_default_is_called_when_nothing_matches():
+    calls = []
+    router = TopicRouter(default=_handler('default', calls))
+    router.route('a', _handler('a', calls))
+    router(None, SimpleNamespace(routing_key='a'), None, b'')
+    router(None, SimpleNamespace(routing_key='b'), None, b'')
+    assert calls == ['a', 'default']
+
+
+def test_route_and_unroute_update_cached_matches():
+    router = TopicRouter()
+    first, second = object(), object()
+    router.route('a.*', first)
+    assert router.match('a.b') == (first,)
+    router.route('#', second)
+    assert router.match('a.b') == (first, second)
+    router.unroute('a.*', first)
+    assert router.match('a.b') == (second,)
+    assert router.binding_keys == ['#']
@@ -0,0 +1,70 @@
+import time
+
+from nrtpygs.mqclient.mqrpccache import RpcCache, args_key
+
+
+def test_args_key_is_canonical():
+    assert args_key({'a': 1, 'b': 2}) == args_key({'b': 2, 'a': 1})
+    assert args_key([1, 2]) != args_key([2, 1])
+
+
+def test_finished_call_is_cached_until_ttl():
+    cache = RpcCache(ttl=0.05, size=10, key=args_key)
+    cache.start('k')
+    assert cache.finish('k', b'payload') == []
+    assert cache.get('k') == b'payload'
+    time.sleep(0.06)
+    assert cache.get('k') is None
+
+
+def test_requests_join_the_call_in_flight():
+    cache = RpcCache(ttl=10, size=10, key=args_key)
+    assert not cache.join('k', 'first')
+    cache.start('k')
+    assert cache.join('k', 'second')
+    assert cache.join('k', 'third')
+    assert cache.finish('k', b'payload') == ['second', 'third']
+    # The call is no longer in flight
+    assert not cache.join('k', 'fourth')
+
+
+def test_failed_call_is_not_cached():
+    cache = RpcCache(ttl=10, size=10, key=args_key)
+    cache.start('k')
+    cache.join('k', 'waiting')
+    assert cache.finish('k', None) == ['waiting']
+    assert cache.get('k') is None
+
+
+def test_invalidate_during_a_call_keeps_the_old_result_out():
+    cache = RpcCache(ttl=10, size=10, key=args_key)
+    cache.start('k')
+    cache.invalidate('k')
+    cache.finish('k', b'stale')
+    assert cache.get('k') is None
+
+
+def test_invalidate_one_key_or_all():
+    cache = RpcCache(ttl=10, size=10, key=args_key)
+    for key in ('a', 'b', 'c'):
+        cache.start(key)
+        cache.finish(key, key.encode())
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.get('b') == b'b'
+    cache.invalidate()
+    assert cache.get('b') is None
+    assert cache.get('c') is None
+
+
+def test_least_recently_used_key_is_evicted():
+    cache = RpcCache(ttl=10, size=2, key=args_key)
+    for key in ('a', 'b'):
+        cache.start(key)
+        cache.finish(key, key.encode())
+    cache.get('a')
+    cache.start('c')
+    cache.finish('c', b'c')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'a'
+    assert cache.get('c') == b'c'